@@ -0,0 +1,203 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import itemgetter, mul
+import csv
+import itertools
+import json
+import math
+
+# NumPy is optional. Without it the same statistics are worked out
+# with bisect over running totals, slower for many groups but with
+# the same answers
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from peewee import fn
+
+from log import Entry, db
+
+# What minutes can be grouped by, None puts every entry in one group
+GROUPS = {
+    None: None,
+    'name': Entry.name,
+    'task': Entry.task,
+}
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+# Reads each group's minutes as two compact arrays, the distinct
+# minutes values in order and how many entries took each. SQLite
+# counts them off the minutes and (name, minutes, timestamp) indexes,
+# so a million entries come back as a few thousand rows, read
+# chunk_size rows at a time straight off the cursor
+def minutes_counts(by=None, start=None, end=None, chunk_size=10000):
+    """Returns {group: (minutes array, counts array)}."""
+    if by not in GROUPS:
+        raise ValueError("Can't group minutes by {}".format(by))
+    column = GROUPS[by]
+    columns = [Entry.minutes] if column is None else [column, Entry.minutes]
+    query = (Entry.select(*columns, fn.COUNT(Entry.id))
+             .group_by(*columns)
+             .order_by(*columns))
+    if start:
+        query = query.where(Entry.timestamp >= start)
+    if end:
+        query = query.where(Entry.timestamp <= end)
+
+    buffers = OrderedDict()
+    cursor = db.execute(query)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        if column is None:
+            rows = [(None,) + row for row in rows]
+        for group, run in itertools.groupby(rows, itemgetter(0)):
+            run = list(run)
+            values, counts = buffers.setdefault(
+                group, (array('q'), array('q')))
+            values.extend(map(itemgetter(1), run))
+            counts.extend(map(itemgetter(2), run))
+    return buffers
+
+# Minutes values, their counts and the running total of the counts,
+# as NumPy arrays when NumPy is there
+class Distribution:
+    """The minutes of a group of entries, counted by value."""
+
+    def __init__(self, values, counts):
+        if numpy is not None:
+            self.values = numpy.frombuffer(values, dtype=numpy.int64)
+            self.counts = numpy.frombuffer(counts, dtype=numpy.int64)
+            self.totals = numpy.cumsum(self.counts)
+            self.below = numpy.concatenate(([0], self.totals))
+        else:
+            self.values = values
+            self.counts = counts
+            self.totals = list(itertools.accumulate(counts))
+            self.below = [0] + self.totals
+        self.entries = int(self.totals[-1]) if len(self.totals) else 0
+
+    def mean(self):
+        if numpy is not None:
+            return float(numpy.dot(self.values, self.counts)) / self.entries
+        return sum(map(mul, self.values, self.counts)) / self.entries
+
+    # The value with this many smaller or equal entries before it
+    def value_at(self, rank):
+        if numpy is not None:
+            return self.values[numpy.searchsorted(self.totals, rank,
+                                                  side='right')]
+        return self.values[bisect_right(self.totals, rank)]
+
+    # The number of entries below a minutes value, or at or below it
+    def entries_below(self, minutes, inclusive=False):
+        if numpy is not None:
+            index = numpy.searchsorted(
+                self.values, minutes, side='right' if inclusive else 'left')
+        else:
+            index = (bisect_right if inclusive else bisect_left)(
+                self.values, minutes)
+        return self.below[index]
+
+    # Percentiles interpolating between the nearest entries, like
+    # numpy.percentile over every entry's minutes
+    def percentiles(self, points=DEFAULT_PERCENTILES):
+        if any(not 0 <= point <= 100 for point in points):
+            raise ValueError("percentiles go from 0 to 100")
+        if not self.entries:
+            return [None for point in points]
+        results = []
+        for point in points:
+            position = (self.entries - 1) * point / 100
+            low = math.floor(position)
+            below = self.value_at(low)
+            above = self.value_at(min(low + 1, self.entries - 1))
+            results.append(float(below + (above - below) * (position - low)))
+        return results
+
+    # Splits the range from the least to the most minutes into bins of
+    # equal width, returns the bin edges and the entries in each bin.
+    # Like numpy.histogram the last bin includes its upper edge
+    def histogram(self, bins=10):
+        if not self.entries:
+            return [], []
+        low, high = float(self.values[0]), float(self.values[-1])
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        width = (high - low) / bins
+        edges = [low + width * number for number in range(bins)] + [high]
+        bounds = ([self.entries_below(edge) for edge in edges[:-1]] +
+                  [self.entries_below(edges[-1], inclusive=True)])
+        counts = [int(bounds[number + 1] - bounds[number])
+                  for number in range(bins)]
+        return edges, counts
+
+    # Tukey's fences, k interquartile ranges beyond the first and third
+    # quartiles, and (minutes, entries) for each value outside them
+    def outliers(self, k=1.5):
+        if not self.entries:
+            return (None, None), []
+        first, third = self.percentiles((25, 75))
+        low = first - k * (third - first)
+        high = third + k * (third - first)
+        if numpy is not None:
+            outside = (self.values < low) | (self.values > high)
+            found = zip(self.values[outside].tolist(),
+                        self.counts[outside].tolist())
+        else:
+            found = [(value, count)
+                     for value, count in zip(self.values, self.counts)
+                     if value < low or value > high]
+        return (low, high), list(found)
+
+
+# Statistics for each group's minutes, e.g. the 90th percentile of
+# minutes per employee is summary('name', points=[90])
+def summary(by=None, start=None, end=None, points=DEFAULT_PERCENTILES,
+            bins=None, k=1.5):
+    """Returns a dict of statistics for each group."""
+    rows = []
+    for group, (values, counts) in minutes_counts(by, start, end).items():
+        minutes = Distribution(values, counts)
+        fences, found = minutes.outliers(k)
+        row = OrderedDict([(by or 'group', group if by else 'all')])
+        row['entries'] = minutes.entries
+        row['mean'] = round(minutes.mean(), 2)
+        row['min'] = int(minutes.values[0])
+        for point, value in zip(points, minutes.percentiles(points)):
+            row['p{:g}'.format(point)] = value
+        row['max'] = int(minutes.values[-1])
+        row['outliers'] = sum(count for value, count in found)
+        row['low_fence'], row['high_fence'] = fences
+        if bins:
+            edges, bin_counts = minutes.histogram(bins)
+            row['histogram'] = [[edges[number], edges[number + 1], count]
+                                for number, count in enumerate(bin_counts)]
+        rows.append(row)
+    return rows
+
+# Writes the summary as text, csv or one JSON object per line
+def write_summary(out, summary_format, by=None, start=None, end=None,
+                  points=DEFAULT_PERCENTILES, bins=None):
+    rows = summary(by, start, end, points, bins)
+    if summary_format == 'json':
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
+        return
+    if summary_format == 'csv':
+        writer = csv.writer(out)
+    for number, row in enumerate(rows):
+        histogram_rows = row.pop('histogram', [])
+        if summary_format == 'csv':
+            if number == 0:
+                writer.writerow(row)
+            writer.writerow(row.values())
+            continue
+        out.write('\t'.join('{}={}'.format(key, value)
+                            for key, value in row.items()) + '\n')
+        for low, high, count in histogram_rows:
+            out.write('  {:>8.1f} - {:<8.1f} {}\n'.format(low, high, count))
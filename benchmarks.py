@@ -0,0 +1,326 @@
+"""Benchmarks for the search and paging paths.
+
+Builds synthetic entry databases of each size, times every case and
+counts the SQL statements it runs, then compares the results with the
+stored baselines:
+
+    python benchmarks.py                   # compare with baselines
+    python benchmarks.py --sizes 10000     # just the small table
+    python benchmarks.py --save            # record new baselines
+    python benchmarks.py --db-profile production
+
+Write throughput is measured separately, on a fresh database for
+every run, and reported under "writes". Cold start, a new interpreter
+importing log and opening the smallest database, is reported under
+"startup" and checked against STARTUP_BUDGET_MS.
+"""
+from collections import OrderedDict
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import analytics
+import log
+from profiling import QueryProfiler
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'benchmark_baselines.json')
+DATA_DIR = '.benchmarks'
+SIZES = [10000, 100000, 1000000]
+
+# Launching on an up to date database, from the first import to an
+# initialized database, should take less than this
+STARTUP_BUDGET_MS = 250
+
+WORDS = ['deploy', 'review', 'meeting', 'bugfix', 'design', 'testing',
+         'support', 'planning', 'release', 'refactor', 'docs', 'hiring']
+FIRST_DAY = datetime.date(2014, 1, 1)
+DAYS = 5 * 365
+
+
+# Yields reproducible synthetic entries ready for import_entries
+def synthetic_rows(size, seed=0):
+    rng = random.Random(seed)
+    for number in range(size):
+        day = FIRST_DAY + datetime.timedelta(days=rng.randrange(DAYS))
+        yield {
+            'name': 'employee{}'.format(rng.randrange(200)),
+            'task': '{} {}'.format(rng.choice(WORDS), number),
+            'minutes': rng.randint(1, 480),
+            'notes': ' '.join(rng.choice(WORDS) for _ in range(8)),
+            'timestamp': datetime.datetime.combine(day, datetime.time()),
+        }
+
+
+# Points log at a database of the given size, building it the
+# first time it is needed. Returns its path
+def use_database(size, profile='default'):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, 'entries-{}.db'.format(size))
+    exists = os.path.exists(path)
+    log.configure_database(path, profile)
+    log.initialize()
+    if not exists:
+        log.import_entries(synthetic_rows(size), chunk_size=10000)
+    return path
+
+
+# Points log at a new, empty database for the write cases
+def use_scratch_database(profile='default'):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, 'scratch.db')
+    log.configure_database(path, profile)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    log.initialize()
+
+
+# Counts the SQL statements run inside the block
+@contextlib.contextmanager
+def count_queries():
+    profiler = QueryProfiler(log.db)
+    profiler.install()
+    try:
+        with profiler.action('benchmark') as stats:
+            yield stats
+    finally:
+        profiler.uninstall()
+
+
+# The cases start with an empty search cache unless they are
+# measuring the cache itself
+def first_page(search_query=None, method=None, cached=False):
+    if not cached:
+        log.search_cache.clear()
+    return log.result_cursor(search_query, method).entry
+
+
+def page_forward(pages=100):
+    log.search_cache.clear()
+    cursor = log.result_cursor()
+    for _ in range(pages):
+        cursor.next()
+    return cursor.entry
+
+
+def page_backward(pages=100):
+    log.search_cache.clear()
+    cursor = log.result_cursor()
+    cursor.seek(1000)
+    for _ in range(pages):
+        cursor.previous()
+    return cursor.entry
+
+
+def seek_middle():
+    log.search_cache.clear()
+    cursor = log.result_cursor()
+    cursor.seek(log.Entry.select().count() // 2)
+    return cursor.entry
+
+
+# One transaction per entry, like add_entry
+def add_entries(count=100):
+    for row in itertools.islice(synthetic_rows(count), count):
+        log.Entry.create(**row)
+
+
+def import_rows(count=10000):
+    log.import_entries(synthetic_rows(count))
+
+
+def employee_names():
+    log.lookup_cache.clear()
+    return log.get_employee_names(log.Entry.select())
+
+
+def minutes_picker():
+    log.lookup_cache.clear()
+    return log.all_minutes()
+
+
+CASES = OrderedDict([
+    ('view_entries', lambda: first_page()),
+    ('search_term', lambda: first_page('deploy', 'Term')),
+    ('search_term_prefix', lambda: first_page('ref', 'Term')),
+    ('search_term_cached', lambda: first_page('deploy', 'Term', cached=True)),
+    ('search_employee', lambda: first_page('employee42', 'Employee')),
+    ('search_employee_exact', lambda: first_page('employee42', 'Name')),
+    ('match_employees', lambda: log.match_employees('emplyee42')),
+    ('search_minutes', lambda: first_page(90, 'Minutes')),
+    ('search_date', lambda: first_page(datetime.datetime(2016, 6, 1), 'Date')),
+    ('search_range', lambda: first_page([datetime.datetime(2016, 1, 1),
+                                         datetime.datetime(2016, 3, 31)],
+                                        'Range')),
+    ('page_forward_100', page_forward),
+    ('page_backward_100', page_backward),
+    ('seek_middle', seek_middle),
+    ('get_employee_names', employee_names),
+    ('search_minutes_picker', minutes_picker),
+    ('minutes_stats_by_name', lambda: analytics.summary('name')),
+])
+
+
+WRITE_CASES = OrderedDict([
+    ('add_entry_100', add_entries),
+    ('import_10000', import_rows),
+])
+
+
+# Times a case, returning the median milliseconds of its runs
+# and the number of queries one run makes
+def run_case(case, repeat=5, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with count_queries() as counter:
+            start = time.perf_counter()
+            case()
+            timings.append((time.perf_counter() - start) * 1000)
+    return {'ms': round(statistics.median(timings), 3),
+            'queries': counter['queries']}
+
+
+# What a launch does before the menu draws, run in a new interpreter
+# so nothing is imported or connected yet
+STARTUP_SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+import log
+log.configure_database(sys.argv[1], sys.argv[2])
+log.initialize()
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+# Milliseconds from importing log to an initialized database. The
+# fastest run is kept, slower ones are only measuring a busy machine
+def startup_time(path, profile='default', repeat=5):
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, path, profile],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        timings.append(float(output.stdout))
+    return min(timings)
+
+
+# Startup time and the queries initialize runs on an up to date database
+def run_startup(path, profile='default', repeat=5):
+    log.configure_database(path, profile)
+    with count_queries() as counter:
+        log.initialize()
+    return {'ms': round(startup_time(path, profile, repeat), 3),
+            'queries': counter['queries']}
+
+
+# Results are keyed by size, with the profile appended when it
+# isn't the default one, e.g. '10000' or '10000/production'
+def result_key(size, profile):
+    if profile == 'default':
+        return str(size)
+    return '{}/{}'.format(size, profile)
+
+
+def run(sizes, repeat=5, cases=CASES, profile='default', writes=True,
+        startup=True):
+    results = OrderedDict()
+    for size in sizes:
+        use_database(size, profile)
+        results[result_key(size, profile)] = OrderedDict(
+            (name, run_case(case, repeat)) for name, case in cases.items())
+    if startup:
+        path = use_database(min(sizes), profile)
+        results[result_key('startup', profile)] = OrderedDict(
+            [('cold_start', run_startup(path, profile, repeat))])
+    if writes:
+        results[result_key('writes', profile)] = OrderedDict(
+            (name, run_case(case, repeat,
+                            lambda: use_scratch_database(profile)))
+            for name, case in WRITE_CASES.items())
+    return results
+
+
+def load_baselines(path=BASELINES):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baselines:
+        return json.load(baselines)
+
+
+# Returns a message for every case that got slower than its
+# baseline by more than the tolerance or runs more queries.
+# Differences under min_ms are treated as timer noise
+def regressions(results, baselines, tolerance=0.5, min_ms=1.0):
+    found = []
+    for size, cases in results.items():
+        for name, result in cases.items():
+            baseline = baselines.get(size, {}).get(name)
+            if not baseline:
+                continue
+            if result['queries'] > baseline['queries']:
+                found.append("{} @ {}: {} queries, baseline {}".format(
+                    name, size, result['queries'], baseline['queries']))
+            if (result['ms'] > baseline['ms'] * (1 + tolerance) and
+                    result['ms'] - baseline['ms'] > min_ms):
+                found.append("{} @ {}: {}ms, baseline {}ms".format(
+                    name, size, result['ms'], baseline['ms']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="allowed slowdown, 0.5 means 50%% slower")
+    parser.add_argument('--save', action='store_true',
+                        help="store the results as the new baselines")
+    parser.add_argument('--db-profile', default='default',
+                        choices=sorted(log.DATABASE_PROFILES))
+    parser.add_argument('--no-writes', action='store_true',
+                        help="skip the write throughput cases")
+    parser.add_argument('--no-startup', action='store_true',
+                        help="skip the cold start measurement")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat, profile=args.db_profile,
+                  writes=not args.no_writes, startup=not args.no_startup)
+    for size, cases in results.items():
+        print(size)
+        for name, result in cases.items():
+            print("  {:<24}{:>12.3f}ms{:>6} queries".format(
+                name, result['ms'], result['queries']))
+
+    if args.save:
+        baselines = load_baselines()
+        baselines.update(results)
+        with open(BASELINES, 'w') as out:
+            json.dump(baselines, out, indent=2)
+            out.write('\n')
+        return 0
+
+    found = regressions(results, load_baselines(), args.tolerance)
+    startup = results.get(result_key('startup', args.db_profile))
+    if startup and startup['cold_start']['ms'] > STARTUP_BUDGET_MS:
+        found.append("startup took {}ms, the budget is {}ms".format(
+            startup['cold_start']['ms'], STARTUP_BUDGET_MS))
+    for message in found:
+        print("REGRESSION", message)
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
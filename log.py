@@ -1,33 +1,657 @@
+from array import array
 from collections import OrderedDict
+import contextlib
 import datetime
+import hashlib
+import itertools
+import json
+import logging
 import os
 import sys
+import threading
+import time
 
 from peewee import *
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField, match
 
-db = SqliteDatabase('entries.db')
+# Modules only some commands need, like playhouse.migrate, profiling,
+# concurrent.futures, csv and queue, are imported where they're used
+# so every launch doesn't pay for them. The ones above are either
+# needed to define the models or already imported by peewee
+
+DEFAULT_DATABASE = 'entries.db'
+
+# SQLite settings for each kind of deployment, applied every time
+# a connection is opened. Pick one with --db-profile or the
+# WORKLOG_DB_PROFILE environment variable
+DATABASE_PROFILES = {
+    # SQLite's own defaults: rollback journal, fsync on every commit
+    'default': {},
+    # WAL lets readers carry on while someone writes, and with
+    # synchronous=normal commits only fsync at checkpoints. Needs
+    # entries.db on a local disk, WAL doesn't work over network shares
+    'production': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'memory',
+        'busy_timeout': 5000,
+    },
+}
+
+# SqliteDatabase with executemany, which runs one statement over many
+# rows. The query profiler counts it like execute_sql
+class WorkLogDatabase(SqliteDatabase):
+
+    def executemany(self, sql, rows):
+        cursor = self.cursor()
+        cursor.executemany(sql, rows)
+        return cursor
+
+
+db = WorkLogDatabase(DEFAULT_DATABASE)
+
+# Entries whose text only differs in case or spacing are the same entry
+def normalize_text(text):
+    return ' '.join(str(text or '').split()).casefold()
+
+# A hash of what an entry says, the same for every copy of an entry
+# however often it's submitted. Also registered as the entry_hash SQL
+# function so the database can hash entries itself
+@db.func('entry_hash', 5, deterministic=True)
+def entry_hash(name, task, minutes, notes, timestamp):
+    content = '\x1f'.join([normalize_text(name), normalize_text(task),
+                           str(int(minutes)), normalize_text(notes),
+                           str(timestamp)[:10]])
+    return hashlib.blake2b(content.encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+# The fields entry_hash is worked out from, in order
+HASHED_FIELDS = ('name', 'task', 'minutes', 'notes', 'timestamp')
 
 # Create the database table
 class Entry(Model):
 
     name = CharField(max_length=255)
     task = CharField(max_length=255)
-    minutes = IntegerField()
+    minutes = IntegerField(index=True)
     notes = TextField()
-    timestamp = DateTimeField(default = datetime.datetime.today().strftime('%Y-%m-%d'))
+    # Stored as YYYY-mm-dd, so comparisons are exact and can use
+    # the index
+    timestamp = DateField(default=datetime.date.today, index=True)
+    # entry_hash of the other fields. The unique index turns away a
+    # second copy of an entry with one index probe. Saving an entry
+    # and import_entries fill it in
+    content_hash = CharField(max_length=32, null=True, unique=True)
 
     class Meta:
         database = db
+        indexes = (
+            (('name', 'timestamp'), False),
+            # Covers counting each employee's minutes for the analytics,
+            # with or without a date range
+            (('name', 'minutes', 'timestamp'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        self.content_hash = entry_hash(
+            *(getattr(self, name) for name in HASHED_FIELDS))
+        return super().save(*args, **kwargs)
+
+
+# Full-text index over entry tasks and notes. It stores no text
+# of its own, triggers keep it in step with the entry table
+class EntryIndex(FTS5Model):
+
+    rowid = RowIDField()
+    task = SearchField()
+    notes = SearchField()
+
+    class Meta:
+        database = db
+        options = {'content': Entry, 'content_rowid': Entry.id}
+
 
+ENTRY_INDEX_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS entry_index_insert
+       AFTER INSERT ON entry BEGIN
+           INSERT INTO entryindex (rowid, task, notes)
+           VALUES (new.id, new.task, new.notes);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS entry_index_delete
+       AFTER DELETE ON entry BEGIN
+           INSERT INTO entryindex (entryindex, rowid, task, notes)
+           VALUES ('delete', old.id, old.task, old.notes);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS entry_index_update
+       AFTER UPDATE OF task, notes ON entry BEGIN
+           INSERT INTO entryindex (entryindex, rowid, task, notes)
+           VALUES ('delete', old.id, old.task, old.notes);
+           INSERT INTO entryindex (rowid, task, notes)
+           VALUES (new.id, new.task, new.notes);
+       END''',
+]
+
+
+# Minutes and entry counts per day, employee and task. Triggers
+# keep it up to date so reports never re-aggregate raw entries
+class DailyTotal(Model):
+
+    day = DateField()
+    name = CharField(max_length=255)
+    task = CharField(max_length=255)
+    minutes = IntegerField(default=0)
+    entries = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('day', 'name', 'task'), True),
+        )
+
+
+DAILY_TOTAL_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS daily_total_insert
+       AFTER INSERT ON entry BEGIN
+           INSERT INTO dailytotal (day, name, task, minutes, entries)
+           VALUES (date(new.timestamp), new.name, new.task, new.minutes, 1)
+           ON CONFLICT (day, name, task) DO UPDATE
+           SET minutes = minutes + excluded.minutes,
+               entries = entries + 1;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS daily_total_delete
+       AFTER DELETE ON entry BEGIN
+           UPDATE dailytotal
+           SET minutes = minutes - old.minutes, entries = entries - 1
+           WHERE day = date(old.timestamp) AND name = old.name
+               AND task = old.task;
+           DELETE FROM dailytotal
+           WHERE day = date(old.timestamp) AND name = old.name
+               AND task = old.task AND entries = 0;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS daily_total_update
+       AFTER UPDATE OF name, task, minutes, timestamp ON entry BEGIN
+           UPDATE dailytotal
+           SET minutes = minutes - old.minutes, entries = entries - 1
+           WHERE day = date(old.timestamp) AND name = old.name
+               AND task = old.task;
+           DELETE FROM dailytotal
+           WHERE day = date(old.timestamp) AND name = old.name
+               AND task = old.task AND entries = 0;
+           INSERT INTO dailytotal (day, name, task, minutes, entries)
+           VALUES (date(new.timestamp), new.name, new.task, new.minutes, 1)
+           ON CONFLICT (day, name, task) DO UPDATE
+           SET minutes = minutes + excluded.minutes,
+               entries = entries + 1;
+       END''',
+]
+
+
+# Every distinct employee name with its number of entries, kept up
+# to date by triggers like the daily totals
+class Employee(Model):
+
+    name = CharField(max_length=255, unique=True)
+    entries = IntegerField(default=0)
+
+    class Meta:
+        database = db
+
+
+# Trigram index over employee names, so a name can be found from any
+# part of it or with a typo in it without scanning every entry
+class EmployeeIndex(FTS5Model):
+
+    rowid = RowIDField()
+    name = SearchField()
+
+    class Meta:
+        database = db
+        options = {'content': Employee, 'content_rowid': Employee.id,
+                   'tokenize': 'trigram'}
+
+
+EMPLOYEE_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS employee_insert
+       AFTER INSERT ON entry BEGIN
+           INSERT INTO employee (name, entries) VALUES (new.name, 1)
+           ON CONFLICT (name) DO UPDATE SET entries = entries + 1;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS employee_delete
+       AFTER DELETE ON entry BEGIN
+           UPDATE employee SET entries = entries - 1 WHERE name = old.name;
+           DELETE FROM employee WHERE name = old.name AND entries = 0;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS employee_update
+       AFTER UPDATE OF name ON entry BEGIN
+           UPDATE employee SET entries = entries - 1 WHERE name = old.name;
+           DELETE FROM employee WHERE name = old.name AND entries = 0;
+           INSERT INTO employee (name, entries) VALUES (new.name, 1)
+           ON CONFLICT (name) DO UPDATE SET entries = entries + 1;
+       END''',
+]
+
+EMPLOYEE_INDEX_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS employee_index_insert
+       AFTER INSERT ON employee BEGIN
+           INSERT INTO employeeindex (rowid, name) VALUES (new.id, new.name);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS employee_index_delete
+       AFTER DELETE ON employee BEGIN
+           INSERT INTO employeeindex (employeeindex, rowid, name)
+           VALUES ('delete', old.id, old.name);
+       END''',
+]
+
+MODELS = [Entry, EntryIndex, DailyTotal, Employee, EmployeeIndex]
+TRIGGERS = (ENTRY_INDEX_TRIGGERS + DAILY_TOTAL_TRIGGERS +
+            EMPLOYEE_TRIGGERS + EMPLOYEE_INDEX_TRIGGERS)
+
+# The full-text index of each entry table, archives and team
+# databases add theirs
+SEARCH_INDEXES = {Entry: EntryIndex}
+
+# Bumped every time this process writes entries, so cached
+# lookups can tell when they have gone stale
+write_generation = 0
+
+# Cached lookups as {name: (data_generation(), value)}
+lookup_cache = {}
+
+# Set by main() when profiling is switched on
+profiler = None
+
+# Set by start_writer() when entries are written in the background
+entry_writer = None
+
+
+# Attributes the queries run inside a with block to a user
+# action when profiling is on, does nothing otherwise
+def profile(action):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.action(action)
 
 # Clear the screen
 def clear():
     os.system('cls' if os.name == 'nt' else 'clear')
 
-# Initialize the database
+# Marks the entries as changed
+def entries_changed():
+    global write_generation
+    write_generation += 1
+
+# Changes whenever entries are written, by this process or, going
+# by SQLite's data_version, by any other connection
+def data_generation():
+    return write_generation, db.pragma('data_version')
+
+# Returns a cached value, rebuilding it if entries were written
+# since it was cached
+def cached_lookup(name, build):
+    generation, value = lookup_cache.get(name, (None, None))
+    current = data_generation()
+    if generation != current:
+        value = build()
+        lookup_cache[name] = (current, value)
+    return value
+
+# Points the models at a database file with one of the profiles
+def configure_database(path=DEFAULT_DATABASE, profile='default'):
+    if not db.is_closed():
+        db.close()
+    db.init(path, pragmas=DATABASE_PROFILES[profile])
+
+# Schema migrations for databases created by older versions.
+# Each one runs once, in order, and the number of migrations
+# applied is stored in the database's user_version pragma
+def add_entry_indexes(migrator):
+    from playhouse.migrate import migrate
+    migrate(
+        migrator.add_index('entry', ('timestamp',)),
+        migrator.add_index('entry', ('name', 'timestamp')),
+        migrator.add_index('entry', ('minutes',)),
+    )
+
+def add_entry_search_index(migrator):
+    db.create_tables([EntryIndex])
+    create_triggers(ENTRY_INDEX_TRIGGERS)
+    EntryIndex.rebuild()
+
+def add_daily_totals(migrator):
+    db.create_tables([DailyTotal])
+    create_triggers(DAILY_TOTAL_TRIGGERS)
+    db.execute_sql('''INSERT INTO dailytotal (day, name, task, minutes, entries)
+                      SELECT date(timestamp), name, task, SUM(minutes), COUNT(*)
+                      FROM entry GROUP BY 1, 2, 3''')
+
+# Older versions stored full datetimes and date strings side by
+# side, this turns them all into plain dates. The rollup trigger is
+# dropped meanwhile, the day of each entry doesn't change
+def store_dates(migrator):
+    db.execute_sql('DROP TRIGGER IF EXISTS daily_total_update')
+    db.execute_sql('''UPDATE entry SET timestamp = date(timestamp)
+                      WHERE date(timestamp) IS NOT NULL
+                          AND timestamp <> date(timestamp)''')
+    create_triggers(DAILY_TOTAL_TRIGGERS)
+
+def add_employee_index(migrator):
+    db.create_tables([Employee, EmployeeIndex])
+    create_triggers(EMPLOYEE_TRIGGERS + EMPLOYEE_INDEX_TRIGGERS)
+    db.execute_sql('''INSERT INTO employee (name, entries)
+                      SELECT name, COUNT(*) FROM entry GROUP BY name''')
+
+def add_minutes_index(migrator):
+    from playhouse.migrate import migrate
+    migrate(migrator.add_index('entry', ('name', 'minutes', 'timestamp')))
+
+# Entries that repeat another entry. Databases from before content
+# hashes can hold copies the unique index would now turn away,
+# upgrading leaves the copies without a hash rather than deleting
+# them, and the dedupe command removes them
+def duplicate_entries(model=Entry):
+    other = model.alias()
+    return model.select().where(
+        model.content_hash.is_null() &
+        fn.EXISTS(other.select(SQL('1')).where(
+            other.content_hash == fn.entry_hash(
+                *(getattr(model, name) for name in HASHED_FIELDS)))))
+
+# Deletes the duplicate entries, returns how many were deleted. The
+# delete triggers take them off the search index and rollups
+def remove_duplicates(model=Entry):
+    with db.atomic():
+        return (model.delete()
+                .where(model.id.in_(
+                    duplicate_entries(model).select(model.id)))
+                .execute())
+
+# Adds the content_hash column to an entry table made by an older
+# version: hashes every entry, takes the hash off all but the first
+# of each set of duplicates and only then adds the unique index.
+# Returns how many duplicates were found
+def add_content_hash(model):
+    table = model._meta.table_name
+    if model._meta.schema:
+        table = '{}.{}'.format(model._meta.schema, table)
+    db.execute_sql('ALTER TABLE {} ADD COLUMN content_hash VARCHAR(32)'
+                   .format(table))
+    (model.update(content_hash=fn.entry_hash(
+        *(getattr(model, name) for name in HASHED_FIELDS)))
+     .execute())
+    first = (model.select(fn.MIN(model.id))
+             .group_by(model.content_hash))
+    found = (model.update(content_hash=None)
+             .where(model.id.not_in(first))
+             .execute())
+    if found:
+        logging.getLogger('worklog').warning(
+            "Found %d duplicate entries in %s, run dedupe to remove them",
+            found, table)
+    model._schema.create_indexes(safe=True)
+    return found
+
+def add_content_hashes(migrator):
+    add_content_hash(Entry)
+
+MIGRATIONS = [
+    add_entry_indexes,
+    add_entry_search_index,
+    add_daily_totals,
+    store_dates,
+    add_employee_index,
+    add_minutes_index,
+    add_content_hashes,
+]
+
+# Creates the triggers that keep derived tables up to date
+def create_triggers(triggers):
+    for trigger in triggers:
+        db.execute_sql(trigger)
+
+# Applies any migrations the database hasn't had yet
+def migrate_database():
+    from playhouse.migrate import SqliteMigrator
+    migrator = SqliteMigrator(db)
+    version = db.pragma('user_version')
+    for migration in MIGRATIONS[version:]:
+        version += 1
+        with db.atomic():
+            migration(migrator)
+            db.pragma('user_version', version)
+
+# Initialize the database. A database that is already current,
+# which is every launch but the first after an upgrade, costs one
+# pragma read and no DDL
 def initialize():
     db.connect()
-    db.create_tables([Entry], safe=True)
+    if db.pragma('user_version') == len(MIGRATIONS):
+        return
+    if Entry.table_exists():
+        migrate_database()
+    else:
+        # A new database gets the current schema straight away
+        db.create_tables(MODELS, safe=True)
+        create_triggers(TRIGGERS)
+        db.pragma('user_version', len(MIGRATIONS))
+
+# Entries from past years can be moved out to one archive database
+# per year, next to the main one, so the tables and indexes day to
+# day work touches stay small. Archives are attached to the main
+# connection when a search needs them and keep their own full-text
+# index. The daily totals stay in the main database and cover the
+# archived entries too
+archive_models = {}
+
+
+# An archive's full-text index. SQLite wants the bare table name on
+# the left of MATCH, not the schema qualified one
+class ArchivedEntryIndex(EntryIndex):
+
+    @classmethod
+    def match(cls, term):
+        return match(Entity(cls._meta.table_name), term)
+
+
+# The archive file for a year, entries-archive-2019.db for entries.db
+def archive_path(year):
+    if db.database == ':memory:':
+        raise ValueError("In-memory databases can't have archives")
+    base, extension = os.path.splitext(db.database)
+    return '{}-archive-{}{}'.format(base, year, extension or '.db')
+
+# The years that have an archive database
+def archived_years():
+    if db.database == ':memory:':
+        return []
+    base, extension = os.path.splitext(db.database)
+    prefix = os.path.basename(base) + '-archive-'
+    suffix = extension or '.db'
+    years = []
+    for filename in os.listdir(os.path.dirname(base) or '.'):
+        year = filename[len(prefix):-len(suffix)]
+        if (filename.startswith(prefix) and filename.endswith(suffix)
+                and year.isdigit()):
+            years.append(int(year))
+    return sorted(years)
+
+# The entry model for a year's archive, attaching the archive and
+# creating its tables on first use
+def archive_model(year):
+    schema = 'archive_{}'.format(year)
+    if year not in archive_models:
+        meta = {'schema': schema, 'table_name': 'entry'}
+        model = type('ArchivedEntry{}'.format(year), (Entry,),
+                     {'Meta': type('Meta', (), meta)})
+        index_meta = {'schema': schema, 'table_name': 'entryindex',
+                      'options': {'content': 'entry',
+                                  'content_rowid': 'id'}}
+        index = type('ArchivedEntryIndex{}'.format(year),
+                     (ArchivedEntryIndex,),
+                     {'Meta': type('Meta', (), index_meta)})
+        archive_models[year] = model
+        SEARCH_INDEXES[model] = index
+    model = archive_models[year]
+    attached = [row[1] for row in db.execute_sql('PRAGMA database_list')]
+    if schema not in attached:
+        db.execute_sql('ATTACH DATABASE ? AS {}'.format(schema),
+                       (archive_path(year),))
+        # Archives made before content hashes get theirs once the
+        # triggers are there to keep the rollups right
+        columns = {column.name
+                   for column in db.get_columns('entry', schema)}
+        outdated = bool(columns) and 'content_hash' not in columns
+        if not outdated:
+            db.create_tables([model, SEARCH_INDEXES[model]], safe=True)
+        create_triggers(trigger.replace(
+            'EXISTS ', 'EXISTS {}.'.format(schema), 1)
+            for trigger in ENTRY_INDEX_TRIGGERS)
+        # Temporary triggers can reach across databases, these keep
+        # the main database's daily totals and employees in step with
+        # the archive
+        create_triggers(trigger
+            .replace('CREATE TRIGGER', 'CREATE TEMP TRIGGER', 1)
+            .replace('EXISTS ', 'EXISTS {}_'.format(schema), 1)
+            .replace(' ON entry ', ' ON {}.entry '.format(schema), 1)
+            for trigger in DAILY_TOTAL_TRIGGERS + EMPLOYEE_TRIGGERS)
+        if outdated:
+            add_content_hash(model)
+    return model
+
+# Moves every entry dated before a day into the archive for its
+# year, returns the number of entries moved
+def archive_entries(before):
+    """Archive entries older than a day."""
+    first = (Entry.select(fn.MIN(Entry.timestamp).coerce(False))
+             .where(Entry.timestamp < before).scalar())
+    if first is None:
+        return 0
+    moved = 0
+    for year in range(int(first[:4]), before.year + 1):
+        start = datetime.date(year, 1, 1)
+        end = min(datetime.date(year + 1, 1, 1), before)
+        in_year = (Entry.timestamp >= start) & (Entry.timestamp < end)
+        if not Entry.select().where(in_year).exists():
+            continue
+        model = archive_model(year)
+        fields = [field.name for field in Entry._meta.sorted_fields
+                  if field is not Entry.id]
+        # The archive gives entries ids of its own, ids are reused
+        # once the newest entries have been archived. Its triggers
+        # index them under the new id, and add back what deleting from
+        # the main table takes off the daily totals. An entry already
+        # archived isn't copied again, only deleted
+        archived = model.select(SQL('1')).where(
+            model.content_hash == Entry.content_hash)
+        with db.atomic():
+            (model.insert_from(
+                Entry.select(*[getattr(Entry, name) for name in fields])
+                .where(in_year).order_by(Entry.id),
+                [model._meta.fields[name] for name in fields])
+             .on_conflict(conflict_target=[model.content_hash],
+                          action='nothing')
+             .execute())
+            moved += (Entry.delete()
+                      .where(in_year & (Entry.content_hash.is_null() |
+                                        fn.EXISTS(archived)))
+                      .execute())
+    entries_changed()
+    return moved
+
+# Removes duplicate entries from the log and its archives, returns
+# how many there are. A dry run only counts them
+def dedupe_entries(dry_run=False):
+    models = [Entry] + [archive_model(year) for year in archived_years()]
+    if dry_run:
+        return sum(duplicate_entries(model).count() for model in models)
+    removed = sum(remove_duplicates(model) for model in models)
+    if removed:
+        entries_changed()
+    return removed
+
+# The earliest and latest day a search can match, None where it
+# has no bound
+def search_span(search_query, method):
+    if not search_query:
+        return None, None
+    if method == "Date":
+        return search_query, search_query
+    if method == "Range":
+        return search_query[0], search_query[1]
+    if method == "Filters":
+        if search_query.get('date'):
+            return search_query['date'], search_query['date']
+        return search_query.get('from_date'), search_query.get('to_date')
+    return None, None
+
+# The archived years a search has to look in as well as the main
+# database
+def archive_years(search_query, method):
+    start, end = search_span(search_query, method)
+    return [year for year in archived_years()
+            if (start is None or start.year <= year) and
+               (end is None or year <= end.year)]
+
+# A search's query on the main database followed by one on each
+# archive it reaches
+def search_partitions(search_query=None, method=None):
+    return [search_method(model.select(), search_query, method)
+            for model in [Entry] + [archive_model(year) for year in
+                                    archive_years(search_query, method)]]
+
+# Other teams' databases, searched alongside this one. Each gets its
+# own connection so they can be read at the same time on team_pool's
+# threads. Set with --team-database or WORKLOG_TEAM_DATABASES
+team_models = []
+team_pool = None
+
+# The entry model for another team's database file. Other teams'
+# files are only read, so one made by an older or newer version of
+# the work log is refused rather than migrated. They're opened read
+# only, without the profile's journal settings, which would change
+# the file for its team. Each has one connection, shared by
+# team_pool's threads and this one, so closing it closes the lot
+def team_model(path, profile='default'):
+    if not os.path.exists(path):
+        raise ValueError("No team database at {}".format(path))
+    from urllib.parse import quote
+    pragmas = {name: value
+               for name, value in DATABASE_PROFILES[profile].items()
+               if name not in ('journal_mode', 'synchronous')}
+    team_db = SqliteDatabase(
+        'file:{}?mode=ro'.format(quote(os.path.abspath(path))),
+        pragmas=pragmas, uri=True, thread_safe=False,
+        check_same_thread=False)
+    if team_db.pragma('user_version') != len(MIGRATIONS):
+        team_db.close()
+        raise ValueError("The team database at {} is from another version "
+                         "of the work log, open it with this version once "
+                         "to upgrade it".format(path))
+    name = 'TeamEntry{}'.format(len(team_models))
+    model = type(name, (Entry,), {'Meta': type('Meta', (), {
+        'database': team_db, 'table_name': 'entry'})})
+    index = type(name + 'Index', (EntryIndex,), {'Meta': type('Meta', (), {
+        'database': team_db, 'table_name': 'entryindex',
+        'options': {'content': 'entry', 'content_rowid': 'id'}})})
+    SEARCH_INDEXES[model] = index
+    return model
+
+# Switches searches over to this database plus the given team
+# databases, or back to this database alone with no paths
+def configure_teams(paths, profile='default'):
+    global team_pool
+    models = [team_model(path, profile) for path in paths]
+    for model in team_models:
+        del SEARCH_INDEXES[model]
+        model._meta.database.close()
+    if team_pool is not None:
+        team_pool.shutdown()
+        team_pool = None
+    team_models[:] = models
+    if models:
+        from concurrent.futures import ThreadPoolExecutor
+        team_pool = ThreadPoolExecutor(len(models))
 
 # Main menu for users to add or view entries
 def menu_loop():
@@ -39,7 +663,9 @@ def menu_loop():
     ('p', "Search by Employee"),
     ('m', "Search by Entry Minutes Taken"),
     ('s', "Search by Entry Date"),
-    ('r', "Search by Date Range")
+    ('r', "Search by Date Range"),
+    ('f', "Search by Several Filters"),
+    ('w', "Watch New Entries")
     ])
     choice = None
 
@@ -52,22 +678,30 @@ def menu_loop():
 
         if choice in menu.keys():
             clear()
-            if choice == 'a':
-                add_entry()
-            if choice == 'v':
-                view_entries()
-            if choice == 't':
-                search_term()
-            if choice == 'p':
-                search_employee(Entry.select().where(Entry.name.contains(prep_employee_search(Entry.select().order_by(
-                                Entry.timestamp.desc())))), prep_employee_search(Entry.select().order_by(
-                                Entry.timestamp.desc())))
-            if choice == 'm':
-                search_minutes()
-            if choice == 's':
-                search_date()
-            if choice == 'r':
-                search_range()
+            with profile(menu[choice]):
+                if choice == 'a':
+                    add_entry()
+                if choice == 'v':
+                    view_entries()
+                if choice == 't':
+                    search_term()
+                if choice == 'p':
+                    search = prep_employee_search()
+                    search_employee(employee_entries(search), search)
+                if choice == 'm':
+                    search_minutes()
+                if choice == 's':
+                    search_date()
+                if choice == 'r':
+                    search_range()
+                if choice == 'f':
+                    search_filters()
+                if choice == 'w':
+                    watch_entries()
+
+    # Nothing queued for the background writer is lost on quitting
+    if entry_writer is not None:
+        entry_writer.flush()
 
 # Take a string for names and tasks
 def take_string(message):
@@ -79,12 +713,31 @@ def take_string(message):
             clear()
     return your_string
 
+# Validation shared by the prompts and the import pipeline,
+# both raise ValueError for bad input
+# Whole minutes, typed or read from a file. int() would also take
+# 1.9 or true from a JSON file and quietly make them 1
+def parse_minutes(minutes):
+    if isinstance(minutes, bool) or not isinstance(minutes, (int, str)):
+        raise ValueError("minutes must be an integer")
+    return int(minutes)
+
+def parse_date(date):
+    return datetime.datetime.strptime(date, '%Y-%m-%d')
+
+# A percentile for the stats command, from 0 to 100
+def parse_percentile(percentile):
+    percentile = float(percentile)
+    if not 0 <= percentile <= 100:
+        raise ValueError("percentiles go from 0 to 100")
+    return percentile
+
 # Take an integer for minutes
 def take_minutes(message):
     while True:
         try:
             your_minutes = input(message)
-            your_minutes = int(your_minutes)
+            your_minutes = parse_minutes(your_minutes)
         except ValueError:
             print("Please enter an integer.")
         else:
@@ -99,13 +752,24 @@ def take_date():
     while True:
         try:
             date = input("Enter date (Must be in YYYY-mm-dd format):\n")
-            date = datetime.datetime.strptime(date, '%Y-%m-%d')
+            date = parse_date(date)
         except ValueError:
             print("Must be in YYYY-mm-dd format!")
         else:
             break
     return date
 
+# Takes an optional value, returning None if left blank
+def take_optional(message, parse, error):
+    while True:
+        value = input(message).strip()
+        if not value:
+            return None
+        try:
+            return parse(value)
+        except ValueError:
+            print(error)
+
 # Takes all entry fields except date
 def take_entry():
     your_name = take_string(
@@ -122,8 +786,15 @@ def add_entry():
     """Add an entry."""
     your_name, your_task, your_minutes, your_notes = take_entry()
     if input('Save? [Y/N]').lower() != 'n':
-        Entry.create(name=your_name, task=your_task,
-                     minutes=your_minutes, notes=your_notes)
+        if entry_writer is not None:
+            entry_writer.add(name=your_name, task=your_task,
+                             minutes=your_minutes, notes=your_notes)
+        elif not import_entries([{'name': your_name, 'task': your_task,
+                                  'minutes': your_minutes,
+                                  'notes': your_notes,
+                                  'timestamp': datetime.date.today()}]):
+            print("That entry is already in the log")
+            return
         print("Saved")
 
 # Returns a list with a count of entries
@@ -134,61 +805,584 @@ def count_ids(entries):
         id_count.append(count)
         count += 1
     return id_count
+# Turns a user's search into a full-text query that matches
+# every word as a prefix, e.g. 'depl app' -> '"depl"* "app"*'
+def match_terms(search_query):
+    words = str(search_query).replace('"', ' ').split()
+    return ' '.join('"{}"*'.format(word) for word in words)
+
 # Places the correct query results in entries based on
 # query and method
 def search_method(entries, search_query, method):
+    # Entry or one of the archive partitions' models
+    model = entries.model
 
     if search_query and method == "Term":
-        entries = (entries.where((Entry.task.contains(search_query)) | (Entry.notes.contains(search_query))))
+        index = SEARCH_INDEXES[model]
+        terms = match_terms(search_query)
+        # A search of only spaces and quotes has no words to match,
+        # and an empty MATCH is an FTS5 syntax error
+        entries = (entries.join(index, on=(model.id == index.rowid))
+                   .where(index.match(terms) if terms else SQL('0')))
 
     elif search_query and method == "Employee":
-        entries = (entries.where(Entry.name.contains(search_query)))
+        entries = (entries.where(model.name.contains(search_query)))
+
+    # Exact names, found through the name index
+    elif search_query and method == "Name":
+        if isinstance(search_query, (list, tuple)):
+            entries = entries.where(model.name.in_(list(search_query)))
+        else:
+            entries = entries.where(model.name == search_query)
 
     elif search_query and method == "Minutes":
-        entries = (entries.where(Entry.minutes == (search_query)))
+        entries = (entries.where(model.minutes == (search_query)))
 
     elif search_query and method == "Date":
-        entries = (entries.where(Entry.timestamp == (search_query)))
+        entries = (entries.where(model.timestamp == (search_query)))
 
     elif search_query and method == "Range":
-        entries = (entries.where((Entry.timestamp >= (search_query[0])) &
-                  (Entry.timestamp <= (search_query[1]))))
+        entries = (entries.where((model.timestamp >= (search_query[0])) &
+                  (model.timestamp <= (search_query[1]))))
+
+    elif search_query and method == "Filters":
+        entries = filter_entries(entries, search_query)
     return entries
 
+# The criteria a combined search can use, as keys of a filters dict
+FILTERS = ('term', 'employee', 'minutes', 'min_minutes', 'max_minutes',
+           'date', 'from_date', 'to_date')
+
+# Narrows entries by every filter given, all in a single query so
+# SQLite can start from whichever index is most selective, e.g.
+# filter_entries(Entry.select(), {'employee': 'Alice', 'term': 'deploy',
+#                                 'from_date': july, 'to_date': september})
+def filter_entries(entries, filters):
+    model = entries.model
+    for name, value in filters.items():
+        if name not in FILTERS:
+            raise ValueError("Unknown search filter {}".format(name))
+    if filters.get('term'):
+        entries = search_method(entries, filters['term'], "Term")
+    if filters.get('employee'):
+        entries = search_method(entries, filters['employee'], "Employee")
+    if filters.get('minutes') is not None:
+        entries = entries.where(model.minutes == filters['minutes'])
+    if filters.get('min_minutes') is not None:
+        entries = entries.where(model.minutes >= filters['min_minutes'])
+    if filters.get('max_minutes') is not None:
+        entries = entries.where(model.minutes <= filters['max_minutes'])
+    if filters.get('date'):
+        entries = entries.where(model.timestamp == filters['date'])
+    if filters.get('from_date'):
+        entries = entries.where(model.timestamp >= filters['from_date'])
+    if filters.get('to_date'):
+        entries = entries.where(model.timestamp <= filters['to_date'])
+    return entries
+
+# Term searches are shown best match first
+def ranked_search(search_query, method):
+    if method == "Filters":
+        return bool(search_query and search_query.get('term'))
+    return bool(search_query) and method == "Term"
+
+# The columns the result list shows. Pages hold just these, the
+# full entry is only loaded for the result being displayed
+LIST_COLUMNS = (Entry.id, Entry.task, Entry.timestamp)
+
+# Orders a query by a sort key with the entry id breaking ties
+def order_results(entries, sort_key=None, descending=True):
+    model = entries.model
+    if sort_key is None:
+        sort_key = model.timestamp
+    if descending:
+        return entries.order_by(sort_key.desc(), model.id.desc())
+    return entries.order_by(sort_key.asc(), model.id.asc())
+
+# Holds a window of search results and pages through them
+# with keyset queries on (sort key, id) so each page turn
+# costs one small indexed query no matter how big the log is.
+# Results are newest first unless another sort key is given
+class ResultCursor:
+    """Page through the results of an Entry query."""
+
+    def __init__(self, entries, page_size=10, sort_key=None,
+                 descending=True):
+        self.entries = entries
+        self.page_size = page_size
+        self.sort_key = sort_key if sort_key is not None else Entry.timestamp
+        self.descending = descending
+        self.full_entry = None
+        self.count = None
+        self.generation = None
+        self.rows = []
+        self.offset = 0
+        self.position = 0
+        self.has_next_page = False
+        self.has_previous_page = False
+        self.first_page()
+
+    # The raw stored sort key, so keyset comparisons match the
+    # ORDER BY exactly instead of a converted datetime
+    def _sort_key(self):
+        return fn.ifnull(self.sort_key, '').coerce(False).alias('sort_key')
+
+    def _key(self, entry):
+        return Tuple(Value(entry.sort_key, converter=False), entry.id)
+
+    def _after(self, entry):
+        if self.descending:
+            return Tuple(self.sort_key, Entry.id) < self._key(entry)
+        return Tuple(self.sort_key, Entry.id) > self._key(entry)
+
+    def _before(self, entry):
+        if self.descending:
+            return Tuple(self.sort_key, Entry.id) > self._key(entry)
+        return Tuple(self.sort_key, Entry.id) < self._key(entry)
+
+    def _fetch(self, where=None, reverse=False, offset=None):
+        query = self.entries.select(*LIST_COLUMNS, self._sort_key())
+        if where is not None:
+            query = query.where(where)
+        query = order_results(query, self.sort_key,
+                              self.descending != reverse)
+        if offset:
+            query = query.offset(offset)
+        # One extra row tells us whether another page exists
+        rows = list(query.limit(self.page_size + 1).namedtuples())
+        return rows[:self.page_size], len(rows) > self.page_size
+
+    # The list row for the current result
+    @property
+    def row(self):
+        if self.rows:
+            return self.rows[self.position]
+        return None
+
+    # The full entry for the current result, loaded when asked for
+    @property
+    def entry(self):
+        row = self.row
+        if row is None:
+            return None
+        if self.full_entry is None or self.full_entry.id != row.id:
+            self.full_entry = Entry.get_or_none(Entry.id == row.id)
+        return self.full_entry
+
+    @property
+    def index(self):
+        return self.offset + self.position
+
+    # The number of results, counted once with a single COUNT(*)
+    # rather than by reading them
+    def total(self):
+        if self.count is None:
+            self.count = self.entries.order_by().count()
+        return self.count
+
+    @property
+    def page(self):
+        return self.index // self.page_size + 1
+
+    def page_count(self):
+        return max(-(-self.total() // self.page_size), 1)
+
+    def seek_page(self, page):
+        """Jump to the first result on a page, counting from 1."""
+        return self.seek((page - 1) * self.page_size)
+
+    def is_first(self):
+        return self.index == 0
+
+    def is_last(self):
+        return (not self.has_next_page and
+                self.position >= len(self.rows) - 1)
+
+    def first_page(self):
+        self.rows, self.has_next_page = self._fetch()
+        self.offset = 0
+        self.position = 0
+        self.has_previous_page = False
+
+    def next_page(self):
+        rows, has_next = self._fetch(self._after(self.rows[-1]))
+        if rows:
+            self.offset += len(self.rows)
+            self.rows = rows
+            self.position = 0
+            self.has_previous_page = True
+        self.has_next_page = has_next
+
+    def previous_page(self):
+        rows, has_previous = self._fetch(self._before(self.rows[0]),
+                                         reverse=True)
+        if rows:
+            self.rows = rows[::-1]
+            self.offset -= len(rows)
+            self.position = len(rows) - 1
+            self.has_next_page = True
+        self.has_previous_page = has_previous
+
+    def next(self):
+        if self.position < len(self.rows) - 1:
+            self.position += 1
+        elif self.has_next_page:
+            self.next_page()
+
+    def previous(self):
+        if self.position > 0:
+            self.position -= 1
+        elif self.has_previous_page:
+            self.previous_page()
+
+    def seek(self, index):
+        """Jump to a result by its position, returns False if there
+        is no result at that position."""
+        if index < 0:
+            return False
+        if self.offset <= index < self.offset + len(self.rows):
+            self.position = index - self.offset
+            return True
+        rows, has_next = self._fetch(offset=index)
+        if not rows:
+            return False
+        self.rows = rows
+        self.offset = index
+        self.position = 0
+        self.has_next_page = has_next
+        self.has_previous_page = index > 0
+        return True
+
+    def refresh(self, index=None):
+        """Reload the window after the results have changed."""
+        if index is None:
+            index = self.index
+        self.rows = []
+        if not self.seek(index):
+            self.first_page()
+
+
+# Pages through a list of entry ids, loading one page of entries
+# at a time. Used for cached search results and snapshots.
+# generation is the data generation a snapshot was listed at
+class IdListCursor(ResultCursor):
+    """Page through entries given by id."""
+
+    def __init__(self, ids, page_size=10, generation=None):
+        self.ids = ids
+        super().__init__(None, page_size)
+        self.generation = generation
+
+    # Entries deleted since the ids were listed are dropped from the
+    # list as pages find them and the page is read again, so pages
+    # stay full, the total and positions stay right, and a window
+    # past the end of what's left falls back to the last result
+    def _load(self, index):
+        while True:
+            index = max(min(index, len(self.ids) - 1), 0)
+            page_ids = list(self.ids[index:index + self.page_size])
+            entries = {entry.id: entry for entry in
+                       Entry.select(*LIST_COLUMNS)
+                       .where(Entry.id.in_(page_ids)).namedtuples()}
+            if len(entries) == len(page_ids):
+                break
+            # A copy, the cached list may be shared
+            ids = self.ids[:index]
+            ids.extend(id for id in page_ids if id in entries)
+            ids.extend(self.ids[index + len(page_ids):])
+            self.ids = ids
+        self.rows = [entries[id] for id in page_ids]
+        self.offset = index
+        self.position = 0
+        self.has_previous_page = index > 0
+        self.has_next_page = index + self.page_size < len(self.ids)
+
+    def total(self):
+        return len(self.ids)
+
+    def first_page(self):
+        self._load(0)
+
+    def next_page(self):
+        if self.has_next_page:
+            self._load(self.offset + self.page_size)
+
+    def previous_page(self):
+        if self.has_previous_page:
+            self._load(max(self.offset - self.page_size, 0))
+            self.position = len(self.rows) - 1
+
+    def seek(self, index):
+        if not 0 <= index < len(self.ids):
+            return False
+        if not self.offset <= index < self.offset + len(self.rows):
+            self._load(index)
+            index = self.offset
+        self.position = index - self.offset
+        return True
+
+
+# Pages through the same search over the main database and archives
+# at once. Each page takes a keyset page from every partition and
+# merges them newest first, so a page turn costs one small indexed
+# query per partition
+class MergedCursor(ResultCursor):
+    """Page through the results of several Entry queries."""
+
+    def __init__(self, partitions, page_size=10, executor=None):
+        self.partitions = partitions
+        self.executor = executor
+        super().__init__(None, page_size)
+
+    def total(self):
+        if self.count is None:
+            self.count = sum(entries.order_by().count()
+                             for entries in self.partitions)
+        return self.count
+
+    # Ids repeat across team databases, so the partition number
+    # breaks ties between entries with the same day and id
+    def _key(self, entry):
+        return Tuple(Value(entry.sort_key, converter=False), entry.id,
+                     entry.partition)
+
+    # Keyset conditions are built for each partition's model
+    def _after(self, entry):
+        return lambda model, number: (
+            Tuple(model.timestamp, model.id, number) < self._key(entry))
+
+    def _before(self, entry):
+        return lambda model, number: (
+            Tuple(model.timestamp, model.id, number) > self._key(entry))
+
+    def _fetch(self, where=None, reverse=False, offset=None):
+        import heapq
+        skip = offset or 0
+        pages = []
+        for number, entries in enumerate(self.partitions):
+            model = entries.model
+            query = entries.select(
+                model.id, model.task, model.timestamp,
+                fn.ifnull(model.timestamp, '').coerce(False)
+                .alias('sort_key'),
+                Value(number).alias('partition'))
+            if where is not None:
+                query = query.where(where(model, number))
+            query = order_results(query, descending=not reverse)
+            query = query.limit(skip + self.page_size + 1).namedtuples()
+            # Partitions in other database files are read on the
+            # executor's threads at the same time, the ones sharing
+            # the main connection and its attached archives are read
+            # here
+            if (self.executor is not None and
+                    model._meta.database is not db):
+                pages.append(self.executor.submit(list, query))
+            else:
+                pages.append(list(query))
+        pages = [page if isinstance(page, list) else page.result()
+                 for page in pages]
+        rows = list(itertools.islice(
+            heapq.merge(*pages, key=lambda row: (row.sort_key, row.id,
+                                                 row.partition),
+                        reverse=not reverse),
+            skip, skip + self.page_size + 1))
+        return rows[:self.page_size], len(rows) > self.page_size
+
+    @property
+    def entry(self):
+        row = self.row
+        if row is None:
+            return None
+        model = self.partitions[row.partition].model
+        loaded = self.full_entry
+        if type(loaded) is not model or loaded.id != row.id:
+            self.full_entry = model.get_or_none(model.id == row.id)
+        return self.full_entry
+
+
+# Remembers the ordered result ids of recent searches, dropping
+# the least recently used searches when it holds more than maxsize
+# searches or max_ids ids in total. Searches with more than max_ids
+# results are remembered as too big to cache
+class SearchCache:
+    """A bounded LRU cache of search result ids."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize=32, max_ids=2000000):
+        self.maxsize = maxsize
+        self.max_ids = max_ids
+        self.results = OrderedDict()
+        self.total_ids = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        cached_generation, ids = self.results.get(key, (None, None))
+        if cached_generation != generation:
+            self.misses += 1
+            return self.MISSING
+        self.results.move_to_end(key)
+        self.hits += 1
+        return ids
+
+    def put(self, key, generation, ids):
+        self.discard(key)
+        self.results[key] = (generation, ids)
+        self.total_ids += len(ids or ())
+        while (len(self.results) > self.maxsize or
+               self.total_ids > self.max_ids):
+            self.discard(next(iter(self.results)))
+
+    def discard(self, key):
+        if key in self.results:
+            generation, ids = self.results.pop(key)
+            self.total_ids -= len(ids or ())
+
+    def clear(self):
+        self.results.clear()
+        self.total_ids = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.results), 'maxsize': self.maxsize,
+                'ids': self.total_ids, 'max_ids': self.max_ids,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+search_cache = SearchCache()
+
+# A hashable cache key for a search
+def search_key(search_query, method):
+    if isinstance(search_query, list):
+        search_query = tuple(search_query)
+    elif isinstance(search_query, dict):
+        search_query = tuple(sorted(search_query.items()))
+    return method, search_query
+
+# Returns the ids of a search's results in display order as a
+# compact array, or None if there are too many to be worth caching
+def result_ids(entries, max_ids, sort_key=None, descending=True):
+    query = order_results(entries.select(Entry.id), sort_key, descending)
+    # Straight off the sqlite3 cursor, wrapping each row costs more
+    # than the search
+    ids = array('q', (id for id, in db.execute(query.limit(max_ids + 1))))
+    if len(ids) > max_ids:
+        return None
+    return ids
+
+# Set by main() with --snapshot. Searches then list every result's
+# id in one query and page through that list, so results keep their
+# places however much others add and delete meanwhile, and a page
+# turn is a primary key lookup. Nothing is held open, writers are
+# never blocked. Searches merged across archives or team databases
+# page by keyset as before
+snapshot_results = False
+
+# Returns a cursor over the results of a search, at the given
+# position if there is a result there
+def result_cursor(search_query=None, method=None, index=0, snapshot=None):
+    if snapshot is None:
+        snapshot = snapshot_results
+    entries = search_method(Entry.select(), search_query, method)
+    sort = {}
+    ids = None
+    if team_models:
+        # One query per team database, all run at once and merged
+        # newest first, like archives ranking isn't comparable
+        cursor = MergedCursor([entries] + [
+            search_method(model.select(), search_query, method)
+            for model in team_models], executor=team_pool)
+        if index:
+            cursor.seek(index)
+        return cursor
+
+    partitions = search_partitions(search_query, method)
+    if len(partitions) > 1:
+        # bm25 scores from different indexes don't compare, so
+        # searches reaching into archives are shown newest first
+        cursor = MergedCursor(partitions)
+        if index:
+            cursor.seek(index)
+        return cursor
+
+    if ranked_search(search_query, method):
+        # Best matches first, bm25 scores are lower for better matches
+        sort = {'sort_key': EntryIndex.bm25(), 'descending': False}
+
+        # The first page of a ranked search already scores every
+        # match, so listing all their ids costs no more than showing
+        # one page. Date ordered searches page straight off the
+        # timestamp index and listing their ids would cost far more
+        # than the page itself, so only ranked searches are cached
+        key = search_key(search_query, method)
+        generation = data_generation()
+        ids = search_cache.get(key, generation)
+        if ids is SearchCache.MISSING:
+            ids = result_ids(entries, search_cache.max_ids, **sort)
+            search_cache.put(key, generation, ids)
+
+    elif snapshot:
+        # Too many results to list falls back to keyset paging
+        generation = data_generation()
+        ids = result_ids(entries, search_cache.max_ids)
+
+    if ids is None:
+        cursor = ResultCursor(entries, **sort)
+    else:
+        cursor = IdListCursor(ids, generation=generation if snapshot
+                              else None)
+    if index:
+        cursor.seek(index)
+    return cursor
+
+# Names the pager's actions in query profiles
+PAGE_ACTIONS = {
+    'n': "Next Entry",
+    'p': "Previous Entry",
+    'd': "Delete Entry",
+    'e': "Edit Entry",
+    'a': "Change All Results",
+    'g': "Go to Page",
+    'r': "Reload Results",
+}
+
 # Paginates resultant search entries pending
 # Search query and method
 def view_entries(search_query=None, method=None):
     """View previous entries."""
 
-    entry_count = 0
-    entries = Entry.select().order_by(Entry.timestamp.desc())
-    id_count = count_ids(entries)
+    cursor = result_cursor(search_query, method)
 
     while True:
 
-        if (not search_query) and (not method):
-            entries = Entry.select().order_by(Entry.timestamp.desc())
-            id_count = count_ids(entries)
-        else:
-            entries = search_method(entries, search_query, method)
-            id_count = count_ids(entries)
-
-        if not entries:
+        entry = cursor.entry
+        if entry is None and cursor.rows:
+            # Deleted by someone else since the page was read
+            cursor.refresh()
+            entry = cursor.entry
+        if entry is None:
             input("No Results, press any key to go back: ")
             break
 
-        elif entries:
-            entry = entries[entry_count]
+        else:
             timestamp = entry.timestamp.strftime('%B %d, %Y')
             clear()
             print("Result Task Names:")
-            results_count = 0
-            for result_entry in entries:
+            results_count = cursor.offset
+            for result_entry in cursor.rows:
                 results_count += 1
                 print(str(results_count) + ".",
                       result_entry.task)
 
-            print ("\nPage ", entry_count +1)
+            print("\nResult {} of {}, page {} of {}".format(
+                cursor.index + 1, cursor.total(), cursor.page,
+                cursor.page_count()))
+            if (cursor.generation is not None and
+                    cursor.generation != data_generation()):
+                print("Entries have changed since these results were "
+                      "listed, r) to reload them")
             print(timestamp)
             print('='*len(timestamp))
             print("ID: ", entry.id)
@@ -197,67 +1391,176 @@ def view_entries(search_query=None, method=None):
             print("Number of minutes: ", entry.minutes)
             print("Notes: ", entry.notes)
             print('\n' + '='*len(timestamp))
-            if entry == entries[-1]:
-                print("No Further Pages")
+            if cursor.is_last():
+                print("No Further Results")
             else:
                 print('N) next entry')
-            if entry == entries[0]:
-                print("No Previous Pages")
+            if cursor.is_first():
+                print("No Previous Results")
             else:
                 print('P) previous entry')
             print('Enter a result\'s number to access its page')
+            print('g) go to page')
 
             print('q) return to main menu')
             print('d) delete entry')
             print('e) edit entry')
+            print('a) change all results')
+            print('r) reload results')
 
-            method = None
             next_action = input('Action: ').lower().strip()
             if next_action == 'q':
                 break
-            elif next_action == 'n':
-                if entry == entries[-1]:
-                    pass
-                else:
-                    entry_count += 1
-            elif next_action == 'p':
-                if entry == entries[0]:
-                    pass
-                else:
-                    entry_count -= 1
-
-            elif next_action == 'd':
-                delete_entry(entry)
-                if entry_count > 0:
-                    entry_count -= 1
-            elif next_action == 'e':
-                edit_entry(entry)
-            elif next_action:
-                try:
-                    int(next_action)
-                except ValueError:
-                    pass
-                else:
-                    if int(next_action) - 1 in id_count:
-                        entry_count = int(next_action) - 1
+            with profile(PAGE_ACTIONS.get(next_action, "Go to Result")):
+                if next_action == 'n':
+                    cursor.next()
+                elif next_action == 'p':
+                    cursor.previous()
+
+                # Other teams' databases are only searched, never
+                # changed from here
+                elif (next_action in ('d', 'e') and
+                      entry._meta.database is not db):
+                    input("That entry is in another team's database and "
+                          "can't be changed here, press enter to go on: ")
+                # A snapshot stays as it is after the user's own
+                # changes, deleted entries are skipped when read. The
+                # snapshot only counts as current afterwards if it was
+                # before, and data_version, which the user's own
+                # writes don't change, still shows other connections'
+                elif (next_action in ('d', 'e') and
+                      cursor.generation is not None):
+                    current = cursor.generation == data_generation()
+                    if next_action == 'd':
+                        delete_entry(entry)
+                    else:
+                        edit_entry(entry)
+                    cursor.full_entry = None
+                    cursor.refresh()
+                    if current:
+                        cursor.generation = (write_generation,
+                                             cursor.generation[1])
+                elif next_action == 'd':
+                    delete_entry(entry)
+                    cursor = result_cursor(search_query, method,
+                                           max(cursor.index - 1, 0))
+                elif next_action == 'e':
+                    edit_entry(entry)
+                    cursor = result_cursor(search_query, method, cursor.index)
+                elif next_action == 'r':
+                    cursor = result_cursor(search_query, method, cursor.index)
+                elif next_action == 'a':
+                    change_all(search_query, method)
+                    cursor = result_cursor(search_query, method)
+                elif next_action == 'g':
+                    page = take_optional("Page number: ", int,
+                                         "Please enter an integer.")
+                    if page is not None and 1 <= page <= cursor.page_count():
+                        cursor.seek_page(page)
+                elif next_action:
+                    try:
+                        int(next_action)
+                    except ValueError:
+                        pass
+                    else:
+                        cursor.seek(int(next_action) - 1)
 
 # Removes an entry
 def delete_entry(entry):
     """Delete an entry."""
     if input("Sure? [y/n]").lower() == 'y':
         entry.delete_instance()
+        entries_changed()
 
 # Asks a user to enter new inputs for an entry
 def edit_entry(entry):
     """edit an entry."""
     if input("Sure? [y/n]").lower() == 'y':
         your_name, your_task, your_minutes, your_notes = take_entry()
+        saved = dict(entry.__data__)
         entry.timestamp = take_date()
         entry.name = your_name
         entry.task = your_task
         entry.minutes = your_minutes
         entry.notes = your_notes
-        entry.save()
+        try:
+            with db.atomic():
+                entry.save()
+        except IntegrityError:
+            # Put the entry back as it is in the log
+            entry.__data__ = saved
+            print("That entry is already in the log, not saved")
+            return
+        entries_changed()
+
+# Set based changes to every entry a search finds. Each is one
+# UPDATE or DELETE in one transaction and returns how many entries
+# it changed
+def matching_ids(search_query, method):
+    return search_method(Entry.select(Entry.id), search_query, method)
+
+def delete_matching(search_query, method):
+    with db.atomic():
+        count = (Entry.delete()
+                 .where(Entry.id.in_(matching_ids(search_query, method)))
+                 .execute())
+    entries_changed()
+    return count
+
+# Content hashes are worked out again from the changed fields, an
+# IntegrityError means the changes would duplicate an entry and
+# nothing was changed
+def update_matching(search_query, method, **changes):
+    changes['content_hash'] = fn.entry_hash(
+        *(changes.get(name, getattr(Entry, name)) for name in HASHED_FIELDS))
+    with db.atomic():
+        count = (Entry.update(**changes)
+                 .where(Entry.id.in_(matching_ids(search_query, method)))
+                 .execute())
+    entries_changed()
+    return count
+
+def shift_dates(search_query, method, days):
+    return update_matching(search_query, method, timestamp=fn.date(
+        Entry.timestamp, '{:+d} days'.format(days)))
+
+# Asks what to change on every result of a search and does it
+def change_all(search_query, method):
+    """change all results"""
+    count = search_method(Entry.select(), search_query, method).count()
+    clear()
+    print("Change all {} results:".format(count))
+    if team_models or archive_years(search_query, method):
+        print("Only results in this database are changed, archived "
+              "and other teams' entries are left as they are")
+    print('d) delete them')
+    print('r) reassign to another employee')
+    print('s) shift their dates')
+    print('t) set their task name')
+    action = input('Action: ').lower().strip()
+    if action == 'r':
+        change = {'name': take_string("New employee name: ")}
+    elif action == 't':
+        change = {'task': take_string("New task name: ")}
+    elif action == 's':
+        days = take_minutes("[INTEGER REQUIRED] Days to move them by, "
+                            "negative for earlier: ")
+    elif action != 'd':
+        return 0
+    if input("Change {} entries? [y/n]".format(count)).lower() != 'y':
+        return 0
+    try:
+        if action == 'd':
+            changed = delete_matching(search_query, method)
+        elif action == 's':
+            changed = shift_dates(search_query, method, days)
+        else:
+            changed = update_matching(search_query, method, **change)
+    except IntegrityError:
+        print("That would make some entries duplicates, nothing changed")
+        return 0
+    print("Changed {} entries".format(changed))
+    return changed
 
 # Takes a string to search tasks and notes
 def search_term():
@@ -269,26 +1572,53 @@ def search_term():
             break
     view_entries(search, "Term")
 
+# Returns (name, entry count, total minutes) for each employee
+# in entries, grouped in SQL rather than row by row
+def employee_summary(entries):
+    model = entries.model
+    return list(entries
+                .select(model.name, fn.COUNT(model.id), fn.SUM(model.minutes))
+                .group_by(model.name)
+                .order_by(model.name)
+                .tuples())
+
+# Employee summary for every entry, cached until the next write
+def all_employees():
+    return cached_lookup('employees',
+                         lambda: employee_summary(Entry.select()))
+
+# Returns (minutes, entry count) for each distinct minutes value,
+# cached until the next write
+def all_minutes():
+    return cached_lookup('minutes', lambda: list(
+        Entry.select(Entry.minutes, fn.COUNT(Entry.id))
+        .group_by(Entry.minutes)
+        .order_by(Entry.minutes)
+        .tuples()))
+
 # Shows all employee names
 def get_employee_names(entries):
-    employees = []
-    for result_entry in entries:
-        employee = (result_entry.name)
-        if employee not in employees:
-            employees.append(employee)
-    return employees
+    return [name for name, count, minutes in employee_summary(entries)]
+
+# Prints a numbered list of employee summaries
+def print_employees(employees):
+    employee_count = 0
+    for employee, count, minutes in employees:
+        employee_count +=1
+        print(str(employee_count) + ".", employee,
+              "({} entries, {} minutes)".format(count, minutes))
 
 # Shows list of employee names and takes
 # a search term
-def prep_employee_search(entries):
+def prep_employee_search(entries=None):
     """search employees"""
     clear()
-    employees = get_employee_names(entries)
+    if entries is None:
+        employees = all_employees()
+    else:
+        employees = employee_summary(entries)
     print("Employee Names:")
-    employee_count = 0
-    for employee in employees:
-        employee_count +=1
-        print(str(employee_count) + ".", employee)
+    print_employees(employees)
 
     while True:
         search = input('Enter name to search: ')
@@ -298,30 +1628,82 @@ def prep_employee_search(entries):
             print("Please enter Name to search")
     return search
 
+# The share of a search's three letter runs a name must have to
+# count as a match, so long names don't match on a word or two
+MIN_TRIGRAM_SHARE = 0.5
+
+# The three letter runs of a name, ignoring case like the index
+def trigrams(name):
+    name = name.lower()
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+# Returns up to limit employee names like a search, best first. A
+# name matching the search apart from case is the only result.
+# Otherwise names sharing enough three letter runs with the search
+# are found through the trigram index. When none do, which happens
+# with typos in short names, the closest names by spelling are used
+# instead
+def match_employees(search, limit=10):
+    search = search.strip()
+    names = [name for name, in Employee
+             .select(Employee.name)
+             .where(fn.lower(Employee.name) == search.lower())
+             .tuples()]
+    if names:
+        return names
+    wanted = trigrams(search)
+    if wanted:
+        terms = ' OR '.join('"{}"'.format(trigram.replace('"', '""'))
+                            for trigram in sorted(wanted))
+        candidates = (Employee
+                      .select(Employee.name)
+                      .join(EmployeeIndex,
+                            on=(Employee.id == EmployeeIndex.rowid))
+                      .where(EmployeeIndex.match(terms))
+                      .order_by(EmployeeIndex.bm25())
+                      .tuples())
+        names = list(itertools.islice(
+            (name for name, in candidates.iterator()
+             if len(wanted & trigrams(name)) >=
+             MIN_TRIGRAM_SHARE * len(wanted)),
+            limit))
+    else:
+        names = [name for name, in Employee
+                 .select(Employee.name)
+                 .where(Employee.name.contains(search))
+                 .order_by(Employee.name)
+                 .limit(limit)
+                 .tuples()]
+    if not names:
+        import difflib
+        everyone = [name for name, in Employee.select(Employee.name)
+                    .tuples()]
+        folded = {name.lower(): name for name in everyone}
+        names = [folded[name] for name in difflib.get_close_matches(
+            search.lower(), list(folded), limit, 0.6)]
+    return names
+
+# The entries of every employee matching a search, by exact name
+def employee_entries(search):
+    names = match_employees(search)
+    return Entry.select().where(Entry.name.in_(names))
+
 # Gives user a list of employee names
 # Takes a name from the user and asks if they
 # want to see a list of matching names to search
 # Passes resulting search back to be viewed with
 # the search employee flag
 def search_employee(entries, search):
-    employees = get_employee_names(entries)
-    id_count = count_ids(employees)
-    if len(id_count) > 1:
+    employees = employee_summary(entries)
+    names = [name for name, count, minutes in employees]
+    if len(employees) > 1:
         check = input("There are multiple employees with this name"
               "\nEnter M to see a list of possible matches"
               "\nOr enter anything else to see all search results.").lower()
         if check == "m":
             clear()
             print("Matching Employee Names:")
-            employees = []
-            results_count = 0
-            for result_entry in entries:
-                employee = (result_entry.name)
-                if employee not in employees:
-                    employees.append(employee)
-            for employee in employees:
-                results_count +=1
-                print(str(results_count) + ".", employee)
+            print_employees(employees)
 
             while True:
                 search = input('Enter name to search: ')
@@ -329,9 +1711,14 @@ def search_employee(entries, search):
                     break
                 else:
                     print("Please enter Name to search")
-            view_entries(search, "Employee")
+            if search in names:
+                view_entries(search, "Name")
+            else:
+                view_entries(search, "Employee")
         else:
-            view_entries(search, "Employee")
+            view_entries(names, "Name")
+    elif names:
+        view_entries(names[0], "Name")
     else:
         view_entries(search, "Employee")
 
@@ -343,18 +1730,13 @@ def search_employee(entries, search):
 # flag
 def search_minutes():
     """search by minutes spent"""
-    entries = Entry.select()
     clear()
     print("Minutes spent working:")
-    employee_mins = []
     results_count = 0
-    for result_entry in entries:
-        mins = (result_entry.minutes)
-        if mins not in employee_mins:
-            employee_mins.append(mins)
-    for min in employee_mins:
+    for min, count in all_minutes():
         results_count+=1
-        print("{}.".format(results_count), min)
+        print("{}.".format(results_count), min,
+              "({} entries)".format(count))
 
     while True:
         try:
@@ -384,6 +1766,570 @@ def search_range():
     dates = [first_date, second_date]
     view_entries(dates, "Range")
 
+# Takes any combination of filters and passes them with the
+# Filters flag
+def search_filters():
+    """Search by several filters at once"""
+    print("Leave a filter blank to skip it")
+    filters = {
+        'term': input("Search query: ").strip() or None,
+        'employee': input("Employee name: ").strip() or None,
+        'min_minutes': take_optional("Fewest minutes: ", parse_minutes,
+                                     "Please enter an integer."),
+        'max_minutes': take_optional("Most minutes: ", parse_minutes,
+                                     "Please enter an integer."),
+        'from_date': take_optional("From date (YYYY-mm-dd): ", parse_date,
+                                   "Must be in YYYY-mm-dd format!"),
+        'to_date': take_optional("To date (YYYY-mm-dd): ", parse_date,
+                                 "Must be in YYYY-mm-dd format!"),
+    }
+    filters = {name: value for name, value in filters.items()
+               if value is not None}
+    if filters:
+        view_entries(filters, "Filters")
+    else:
+        view_entries()
+
+# Yields a query for each lot of entries added after last_seen,
+# oldest first. Between checks it only reads data_version, which
+# costs nothing, and new entries are found through the primary key
+# rather than by re-running a search. Edits and deletes aren't
+# followed, only new entries
+def follow_entries(last_seen=None, interval=1.0):
+    if last_seen is None:
+        last_seen = Entry.select(fn.MAX(Entry.id)).scalar() or 0
+    generation = data_generation()
+    while True:
+        time.sleep(interval)
+        current = data_generation()
+        if current == generation:
+            continue
+        generation = current
+        newest = Entry.select(fn.MAX(Entry.id)).scalar() or 0
+        if newest > last_seen:
+            yield (Entry.select()
+                   .where((Entry.id > last_seen) & (Entry.id <= newest))
+                   .order_by(Entry.id))
+            last_seen = newest
+
+# Prints entries as they are added until interrupted
+def watch_entries(interval=1.0):
+    """Watch new entries"""
+    print("Watching for new entries, press Ctrl+C to stop")
+    try:
+        for entries in follow_entries(interval=interval):
+            for entry in entries:
+                print(entry.timestamp.strftime('%B %d, %Y'), entry.name,
+                      entry.task, "{} minutes".format(entry.minutes),
+                      sep=' | ')
+    except KeyboardInterrupt:
+        pass
+
+# Columns used by the import and export files
+ENTRY_COLUMNS = ['name', 'task', 'minutes', 'notes', 'date']
+
+# Works out a file's format from its extension
+def file_format(path, file_format=None):
+    if file_format:
+        return file_format
+    if path.endswith(('.jsonl', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+# Yields each row of a CSV file as a dict, or each line of a JSON
+# Lines file for validate_row to parse, so a malformed line is
+# skipped like any other bad row
+def read_rows(lines, file_format):
+    if file_format == 'jsonl':
+        for line in lines:
+            if line.strip():
+                yield line
+    else:
+        import csv
+        yield from csv.DictReader(lines)
+
+# Checks a row with the same rules as the prompts and returns
+# the values to insert
+def validate_row(row):
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError as error:
+            raise ValueError("not valid JSON, {}".format(error))
+    if not isinstance(row, dict):
+        raise ValueError("must be an object of entry fields")
+    for field in ('name', 'task', 'notes', 'date'):
+        if row.get(field) is not None and not isinstance(row[field], str):
+            raise ValueError("{} must be text".format(field))
+    name = (row.get('name') or '').strip()
+    task = (row.get('task') or '').strip()
+    if not name or not task:
+        raise ValueError("name and task are required")
+    try:
+        minutes = parse_minutes(row.get('minutes'))
+    except (TypeError, ValueError):
+        raise ValueError("minutes must be an integer")
+    try:
+        timestamp = parse_date(row.get('date') or '')
+    except (TypeError, ValueError):
+        raise ValueError("date must be in YYYY-mm-dd format")
+    return {'name': name, 'task': task, 'minutes': minutes,
+            'notes': row.get('notes') or '', 'timestamp': timestamp}
+
+# Validates rows, reporting and skipping bad ones
+def valid_rows(rows):
+    for number, row in enumerate(rows, 1):
+        try:
+            yield validate_row(row)
+        except ValueError as error:
+            print("Skipped row {}: {}".format(number, error),
+                  file=sys.stderr)
+
+# Chunks of at least this many rows are imported with the insert
+# triggers paused
+BULK_IMPORT_ROWS = 1000
+
+# The triggers run for every entry inserted, by name
+INSERT_TRIGGERS = OrderedDict([
+    ('entry_index_insert', ENTRY_INDEX_TRIGGERS[0]),
+    ('daily_total_insert', DAILY_TOTAL_TRIGGERS[0]),
+    ('employee_insert', EMPLOYEE_TRIGGERS[0]),
+])
+
+# Bring the search index, daily totals and employees up to date with
+# the entries after a given id, what the insert triggers would have
+# done for them one at a time
+CATCH_UP = [
+    '''INSERT INTO entryindex (rowid, task, notes)
+       SELECT id, task, notes FROM entry WHERE id > ?''',
+    '''INSERT INTO dailytotal (day, name, task, minutes, entries)
+       SELECT date(timestamp), name, task, SUM(minutes), COUNT(*)
+       FROM entry WHERE id > ? GROUP BY 1, 2, 3
+       ON CONFLICT (day, name, task) DO UPDATE
+       SET minutes = minutes + excluded.minutes,
+           entries = entries + excluded.entries''',
+    '''INSERT INTO employee (name, entries)
+       SELECT name, COUNT(*) FROM entry WHERE id > ? GROUP BY name
+       ON CONFLICT (name) DO UPDATE
+       SET entries = entries + excluded.entries''',
+]
+
+# Runs the inserts in the block without the insert triggers, then
+# catches the derived tables up on every new entry at once, which
+# more than halves the time a big import takes. Has to be used
+# inside a transaction, so other connections never see the triggers
+# missing and a failed chunk puts them back. New entries get ids
+# above the largest one, updated duplicates keep theirs and their
+# update triggers still run
+@contextlib.contextmanager
+def insert_triggers_paused():
+    last = Entry.select(fn.MAX(Entry.id)).scalar() or 0
+    for name in INSERT_TRIGGERS:
+        db.execute_sql('DROP TRIGGER {}'.format(name))
+    yield
+    for sql in CATCH_UP:
+        db.execute_sql(sql, (last,))
+    create_triggers(INSERT_TRIGGERS.values())
+
+# What import_entries does with a row that's already an entry:
+# 'skip' leaves the entry alone, 'update' takes the row's spelling
+# of the name, task and notes
+DUPLICATES = ('skip', 'update')
+
+# Inserts rows in chunks, one transaction per chunk, and
+# returns how many were inserted. The INSERT is built once and
+# run with executemany, building it per row with insert_many
+# costs more than SQLite spends writing the rows. Duplicates are
+# caught by the content_hash index as part of the INSERT and not
+# counted unless they update an entry. Big chunks are inserted with
+# the insert triggers paused
+def import_entries(rows, chunk_size=1000, duplicates='skip'):
+    if duplicates not in DUPLICATES:
+        raise ValueError("duplicates must be one of {}".format(
+            ', '.join(DUPLICATES)))
+    fields = [Entry.name, Entry.task, Entry.minutes, Entry.notes,
+              Entry.timestamp]
+    query = Entry.insert({field: None for field in
+                          fields + [Entry.content_hash]})
+    if duplicates == 'skip':
+        query = query.on_conflict(conflict_target=[Entry.content_hash],
+                                  action='nothing')
+    else:
+        query = query.on_conflict(conflict_target=[Entry.content_hash],
+                                  preserve=[Entry.name, Entry.task,
+                                            Entry.notes])
+    sql, _ = query.sql()
+    imported = 0
+    rows = iter(rows)
+    while True:
+        chunk = []
+        for row in itertools.islice(rows, chunk_size):
+            values = [field.db_value(row[field.name]) for field in fields]
+            chunk.append(values + [entry_hash(*values)])
+        if not chunk:
+            break
+        bulk = len(chunk) >= BULK_IMPORT_ROWS
+        with db.atomic(), (insert_triggers_paused() if bulk
+                           else contextlib.nullcontext()):
+            cursor = db.executemany(sql, chunk)
+        imported += cursor.rowcount
+    if imported:
+        entries_changed()
+    return imported
+
+# Collects entries from any thread and writes them on a background
+# thread in batches, one transaction per batch, so whoever adds
+# entries never waits for a commit. A batch is written once it has
+# batch_size entries or its first entry has waited flush_interval
+# seconds. durability sets the writer connection's synchronous
+# pragma: 'full' fsyncs every batch, 'normal' is safe in WAL mode
+# but may lose the last batches on power loss, 'off' leaves it to
+# the operating system
+class EntryWriter:
+    """Writes entries in batches on a background thread."""
+
+    DURABILITY = ('full', 'normal', 'off')
+    FLUSH = object()
+    STOP = object()
+
+    def __init__(self, batch_size=500, flush_interval=0.5,
+                 durability='full'):
+        if durability not in self.DURABILITY:
+            raise ValueError("durability must be one of {}".format(
+                ', '.join(self.DURABILITY)))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        import queue
+        self.queue = queue.Queue()
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='entry-writer')
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def add(self, name, task, minutes, notes='', timestamp=None):
+        """Queues an entry and returns straight away."""
+        if timestamp is None:
+            timestamp = datetime.date.today()
+        self.queue.put({'name': name, 'task': task, 'minutes': minutes,
+                        'notes': notes, 'timestamp': timestamp})
+
+    def flush(self):
+        """Waits until everything queued so far is written."""
+        self.queue.put(self.FLUSH)
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.queue.put(self.STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    # Blocks for the first entry of a batch, then takes whatever
+    # else arrives until the batch is full, its time is up or a
+    # flush or stop is asked for
+    def next_batch(self):
+        import queue
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while (batch[-1] is not self.STOP and batch[-1] is not self.FLUSH
+               and len(batch) < self.batch_size):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        db.connect(reuse_if_open=True)
+        db.pragma('synchronous', self.durability)
+        try:
+            while True:
+                batch = self.next_batch()
+                entries = [entry for entry in batch
+                           if entry is not self.STOP and entry is not self.FLUSH]
+                try:
+                    if entries:
+                        self.written += import_entries(entries, len(entries))
+                except Exception as error:
+                    logging.getLogger('worklog').exception(
+                        "Lost %d queued entries", len(entries))
+                    self.error = error
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if batch[-1] is self.STOP:
+                    break
+        finally:
+            db.close()
+
+# Starts writing added entries in the background
+def start_writer(batch_size=500, flush_interval=0.5, durability='full'):
+    global entry_writer
+    entry_writer = EntryWriter(batch_size, flush_interval, durability).start()
+    return entry_writer
+
+def stop_writer():
+    global entry_writer
+    writer, entry_writer = entry_writer, None
+    writer.close()
+
+# The entries of several partitions merged by date, read a row at
+# a time from each
+def merge_partitions(partitions, descending=False):
+    import heapq
+    rows = [order_results(entries.select(
+                entries.model.name, entries.model.task,
+                entries.model.minutes, entries.model.notes,
+                entries.model.timestamp), descending=descending)
+            .tuples().iterator()
+            for entries in partitions]
+    return heapq.merge(*rows, key=lambda row: row[4], reverse=descending)
+
+# Writes entries out one row at a time without loading them
+# all into memory, returns how many were written. A list of
+# partitions is written merged by date, every entry including
+# archived ones oldest first by default
+def export_entries(out, file_format, entries=None, descending=False):
+    if entries is None:
+        entries = search_partitions()
+    if isinstance(entries, list):
+        rows = merge_partitions(entries, descending)
+    else:
+        rows = entries.select(Entry.name, Entry.task, Entry.minutes,
+                              Entry.notes, Entry.timestamp).tuples().iterator()
+    if file_format == 'csv':
+        import csv
+        writer = csv.writer(out)
+        writer.writerow(ENTRY_COLUMNS)
+    exported = 0
+    for name, task, minutes, notes, timestamp in rows:
+        row = [name, task, minutes, notes, timestamp.strftime('%Y-%m-%d')]
+        if file_format == 'csv':
+            writer.writerow(row)
+        elif file_format == 'text':
+            out.write('\t'.join(str(value) for value in row) + '\n')
+        else:
+            out.write(json.dumps(dict(zip(ENTRY_COLUMNS, row))) + '\n')
+        exported += 1
+    return exported
+
+# Opens a file for import or export, '-' means stdin or stdout
+def open_file(path, mode):
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode, newline='')
+
+# Command line arguments, running with none shows the menu
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Work log")
+    parser.add_argument('--profile', action='store_true',
+                        help="print the queries each action ran on exit")
+    parser.add_argument('--profile-out',
+                        help="write the session's query profile as JSON")
+    parser.add_argument('--slow-ms', type=float,
+                        help="log queries slower than this with their plan")
+    parser.add_argument('--slow-log',
+                        help="file for the slow query log, default stderr")
+    parser.add_argument('--database', default=os.environ.get(
+                            'WORKLOG_DATABASE', DEFAULT_DATABASE))
+    parser.add_argument('--db-profile', choices=sorted(DATABASE_PROFILES),
+                        default=os.environ.get('WORKLOG_DB_PROFILE',
+                                               'default'))
+    parser.add_argument('--write-queue', action='store_true',
+                        help="save added entries on a background thread")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--flush-ms', type=float, default=500)
+    parser.add_argument('--durability', choices=EntryWriter.DURABILITY,
+                        default='full')
+    parser.add_argument('--team-database', action='append',
+                        dest='team_databases', default=[
+                            path for path in os.environ.get(
+                                'WORKLOG_TEAM_DATABASES', ''
+                            ).split(os.pathsep) if path],
+                        help="also search this team's database, repeatable")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="keep search results in place while others "
+                             "add and delete entries")
+    commands = parser.add_subparsers(dest='command')
+
+    import_parser = commands.add_parser(
+        'import', help="add entries from a CSV or JSON Lines file")
+    import_parser.add_argument('file', help="file to read, - for stdin")
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'])
+    import_parser.add_argument('--chunk-size', type=int, default=1000)
+    import_parser.add_argument(
+        '--duplicates', choices=DUPLICATES, default='skip',
+        help="skip rows already in the log or update them to the "
+             "row's spelling")
+
+    export_parser = commands.add_parser(
+        'export', help="write entries to a CSV or JSON Lines file")
+    export_parser.add_argument('file', help="file to write, - for stdout")
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'])
+
+    search_parser = commands.add_parser(
+        'search', help="print matching entries, newest first")
+    search_parser.add_argument('--term')
+    search_parser.add_argument('--employee')
+    search_parser.add_argument('--minutes', type=parse_minutes)
+    search_parser.add_argument('--min-minutes', type=parse_minutes)
+    search_parser.add_argument('--max-minutes', type=parse_minutes)
+    search_parser.add_argument('--date', type=parse_date)
+    search_parser.add_argument('--from', dest='from_date', type=parse_date)
+    search_parser.add_argument('--to', dest='to_date', type=parse_date)
+    search_parser.add_argument('--format', default='text',
+                               choices=['text', 'csv', 'json'])
+
+    report_parser = commands.add_parser(
+        'report', help="total minutes from the daily rollups")
+    report_parser.add_argument('--by', nargs='+', default=['name'],
+                               choices=['name', 'task', 'day', 'week',
+                                        'month', 'year'])
+    report_parser.add_argument('--from', dest='from_date', type=parse_date)
+    report_parser.add_argument('--to', dest='to_date', type=parse_date)
+    report_parser.add_argument('--format', default='text',
+                               choices=['text', 'csv', 'json'])
+
+    stats_parser = commands.add_parser(
+        'stats', help="minutes percentiles, histograms and outliers")
+    stats_parser.add_argument('--by', choices=['name', 'task'])
+    stats_parser.add_argument('--from', dest='from_date', type=parse_date)
+    stats_parser.add_argument('--to', dest='to_date', type=parse_date)
+    stats_parser.add_argument('--percentiles', type=parse_percentile,
+                              nargs='+', default=[50, 90, 99])
+    stats_parser.add_argument('--bins', type=int,
+                              help="add a histogram with this many bins")
+    stats_parser.add_argument('--format', default='text',
+                              choices=['text', 'csv', 'json'])
+
+    follow_parser = commands.add_parser(
+        'follow', help="print entries as they are added")
+    follow_parser.add_argument('--interval', type=float, default=1.0,
+                               help="seconds between checks")
+    follow_parser.add_argument('--format', default='text',
+                               choices=['text', 'json'])
+
+    archive_parser = commands.add_parser(
+        'archive', help="move older entries into yearly archive files")
+    archive_parser.add_argument('--before', required=True, type=parse_date,
+                                help="archive entries dated before this")
+
+    dedupe_parser = commands.add_parser(
+        'dedupe', help="remove entries that repeat another entry")
+    dedupe_parser.add_argument('--dry-run', action='store_true',
+                               help="only count the duplicates")
+
+    return parser.parse_args(argv)
+
+# Builds the search command's queries from its options, one for
+# the main database and each archive the dates reach
+def search_query(args):
+    filters = {name: getattr(args, name) for name in FILTERS}
+    return search_partitions(filters, "Filters")
+
+# Switches on query profiling for the session
+def start_profiling(slow_ms=None, slow_log=None):
+    global profiler
+    from profiling import QueryProfiler
+    logging.basicConfig(filename=slow_log, format='%(asctime)s %(message)s')
+    profiler = QueryProfiler(db, slow_ms)
+    profiler.install()
+    return profiler
+
+def stop_profiling(report=False, profile_out=None):
+    global profiler
+    profiler.uninstall()
+    if report:
+        print(profiler.report(), file=sys.stderr)
+        print("Search cache:", search_cache.stats(), file=sys.stderr)
+    if profile_out:
+        with open(profile_out, 'w') as out:
+            profiler.dump(out)
+    profiler = None
+
+def main(argv=None):
+    global snapshot_results
+    args = parse_args(argv)
+    configure_database(args.database, args.db_profile)
+    snapshot_results = args.snapshot
+    profiling = args.profile or args.profile_out or args.slow_ms is not None
+    if profiling:
+        start_profiling(args.slow_ms, args.slow_log)
+    try:
+        initialize()
+        if args.team_databases:
+            configure_teams(args.team_databases, args.db_profile)
+        if args.write_queue:
+            start_writer(args.batch_size, args.flush_ms / 1000,
+                         args.durability)
+        try:
+            run_command(args)
+        finally:
+            if entry_writer is not None:
+                stop_writer()
+            if team_models:
+                configure_teams([])
+    finally:
+        if profiling:
+            stop_profiling(args.profile, args.profile_out)
+
+def run_command(args):
+    if args.command == 'import':
+        with open_file(args.file, 'r') as lines:
+            rows = read_rows(lines, file_format(args.file, args.format))
+            count = import_entries(valid_rows(rows), args.chunk_size,
+                                   args.duplicates)
+        print("Imported {} entries".format(count), file=sys.stderr)
+    elif args.command == 'export':
+        with open_file(args.file, 'w') as out:
+            count = export_entries(out, file_format(args.file, args.format))
+        print("Exported {} entries".format(count), file=sys.stderr)
+    elif args.command == 'report':
+        import reports
+        reports.write_report(sys.stdout, args.format, args.by,
+                             args.from_date, args.to_date)
+    elif args.command == 'stats':
+        import analytics
+        analytics.write_summary(sys.stdout, args.format, args.by,
+                                args.from_date, args.to_date,
+                                args.percentiles, args.bins)
+    elif args.command == 'follow':
+        try:
+            for entries in follow_entries(interval=args.interval):
+                export_entries(sys.stdout,
+                               'jsonl' if args.format == 'json'
+                               else args.format, entries)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'archive':
+        count = archive_entries(args.before)
+        print("Archived {} entries".format(count), file=sys.stderr)
+    elif args.command == 'dedupe':
+        count = dedupe_entries(args.dry_run)
+        print("{} {} duplicate entries".format(
+            "Found" if args.dry_run else "Removed", count), file=sys.stderr)
+    elif args.command == 'search':
+        export_entries(sys.stdout,
+                       'jsonl' if args.format == 'json' else args.format,
+                       search_query(args), descending=True)
+    else:
+        menu_loop()
+
 if __name__ == '__main__':
-    initialize()
-    menu_loop()
+    # reports and analytics import log by name. Make that this module,
+    # the one main() configures, not a second copy of it
+    sys.modules.setdefault('log', sys.modules['__main__'])
+    main()
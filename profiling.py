@@ -0,0 +1,125 @@
+"""Opt-in SQL instrumentation for the work log.
+
+A QueryProfiler wraps a peewee database's execute_sql, and its
+executemany when it has one, counts and times every statement
+against the user action that ran it, logs
+statements slower than a threshold along with their query plan and
+can dump the whole session's profile as text or JSON.
+"""
+from collections import Counter, OrderedDict
+import contextlib
+import json
+import logging
+import time
+
+logger = logging.getLogger('worklog.sql')
+
+
+class QueryProfiler:
+    """Counts and times the SQL run by each user action."""
+
+    def __init__(self, database, slow_ms=None):
+        self.database = database
+        self.slow_ms = slow_ms
+        self.actions = OrderedDict()
+        self.current = None
+        self._execute_sql = None
+        self._executemany = None
+        self.start_action('session')
+
+    def install(self):
+        self._execute_sql = self.database.execute_sql
+        self.database.execute_sql = self.execute_sql
+        if hasattr(self.database, 'executemany'):
+            self._executemany = self.database.executemany
+            self.database.executemany = self.executemany
+
+    def uninstall(self):
+        del self.database.execute_sql
+        self._execute_sql = None
+        if self._executemany is not None:
+            del self.database.executemany
+            self._executemany = None
+
+    def start_action(self, name):
+        if name not in self.actions:
+            self.actions[name] = {'calls': 0, 'queries': 0, 'ms': 0.0,
+                                  'statements': Counter(),
+                                  'statement_ms': Counter()}
+        self.actions[name]['calls'] += 1
+        self.current = name
+
+    # Attributes the queries run inside the block to an action,
+    # e.g. a menu choice or a page turn
+    @contextlib.contextmanager
+    def action(self, name):
+        previous = self.current
+        self.start_action(name)
+        try:
+            yield self.actions[name]
+        finally:
+            self.current = previous
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._execute_sql(sql, params, *args, **kwargs)
+        finally:
+            self.record(sql, params, (time.perf_counter() - start) * 1000)
+
+    # SQLite runs the statement once for each row, each run counts
+    # as a query
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        start = time.perf_counter()
+        try:
+            return self._executemany(sql, rows)
+        finally:
+            self.record(sql, None, (time.perf_counter() - start) * 1000,
+                        len(rows))
+
+    def record(self, sql, params, ms, count=1):
+        stats = self.actions[self.current]
+        stats['queries'] += count
+        stats['ms'] += ms
+        stats['statements'][sql] += count
+        stats['statement_ms'][sql] += ms
+        if self.slow_ms is not None and ms >= self.slow_ms:
+            logger.warning("slow query %.1fms in %s: %s %r\n%s", ms,
+                           self.current, sql, params,
+                           self.explain(sql, params))
+
+    # Returns SQLite's plan for a query, one step per line
+    def explain(self, sql, params=None):
+        if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return ''
+        cursor = self._execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join('  ' + row[-1] for row in cursor.fetchall())
+
+    def profile(self):
+        """Returns the session's statistics as plain data."""
+        return OrderedDict(
+            (name, {'calls': stats['calls'],
+                    'queries': stats['queries'],
+                    'ms': round(stats['ms'], 3),
+                    'statements': [
+                        {'sql': sql, 'count': count,
+                         'ms': round(stats['statement_ms'][sql], 3)}
+                        for sql, count in stats['statements'].most_common()]})
+            for name, stats in self.actions.items() if stats['queries'])
+
+    def report(self, top=3):
+        lines = []
+        for name, stats in self.profile().items():
+            lines.append("{}: {} calls, {} queries ({:.1f} per call), "
+                         "{:.1f}ms".format(name, stats['calls'],
+                                           stats['queries'],
+                                           stats['queries'] / stats['calls'],
+                                           stats['ms']))
+            for statement in stats['statements'][:top]:
+                lines.append("  {count}x {ms}ms {sql}".format(**statement))
+        return '\n'.join(lines)
+
+    def dump(self, out):
+        json.dump(self.profile(), out, indent=2)
+        out.write('\n')
@@ -0,0 +1,63 @@
+import csv
+import json
+
+from peewee import fn
+
+from log import DailyTotal
+
+# Periods days can be grouped into, as SQLite strftime formats
+PERIODS = {
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+
+# The ISO 8601 week of a day, e.g. 2018-W01. Weeks start on Monday
+# and belong to the year their Thursday is in, so the first days of
+# January can be in the last week of the year before. SQLite's %W
+# counts weeks from the first Monday instead, and %G and %V are
+# missing from older SQLite
+def iso_week(day):
+    thursday = fn.date(day, 'weekday 0', '-3 days')
+    return fn.printf('%s-W%02d', fn.strftime('%Y', thursday),
+                     (fn.strftime('%j', thursday) + 6) / 7)
+
+# The column to group by for each report grouping
+def group_column(group):
+    if group == 'week':
+        return iso_week(DailyTotal.day).alias(group)
+    if group in PERIODS:
+        return (fn.strftime(PERIODS[group], DailyTotal.day)
+                .coerce(False).alias(group))
+    if group in ('name', 'task'):
+        return getattr(DailyTotal, group)
+    raise ValueError("Can't group a report by {}".format(group))
+
+# Sums minutes and entries from the daily rollups, grouped by
+# any of name, task, day, week, month and year, e.g. total
+# minutes per employee per week is totals(['name', 'week'])
+def totals(by=('name',), start=None, end=None):
+    """Returns (*groups, minutes, entries) tuples."""
+    columns = [group_column(group) for group in by]
+    query = DailyTotal.select(*columns,
+                              fn.SUM(DailyTotal.minutes),
+                              fn.SUM(DailyTotal.entries))
+    if start:
+        query = query.where(DailyTotal.day >= start)
+    if end:
+        query = query.where(DailyTotal.day <= end)
+    return query.group_by(*columns).order_by(*columns).tuples()
+
+# Writes a report as text, csv or one JSON object per line
+def write_report(out, report_format, by=('name',), start=None, end=None):
+    header = list(by) + ['minutes', 'entries']
+    if report_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(header)
+    for row in totals(by, start, end):
+        if report_format == 'csv':
+            writer.writerow(row)
+        elif report_format == 'json':
+            out.write(json.dumps(dict(zip(header, row))) + '\n')
+        else:
+            out.write('\t'.join(str(value) for value in row) + '\n')
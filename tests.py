@@ -1,11 +1,22 @@
 import datetime
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
 from unittest import TestCase, mock
 from unittest.mock import patch
 
 from peewee import *
 
+import analytics
+import benchmarks
 import log
+import profiling
+import reports
 
 db = SqliteDatabase('testentries.db')
 
@@ -311,5 +322,1337 @@ class LogTests(TestCase):
             with mock.patch('log.search_term') as mock_search:
                 log.menu_loop()
                 mock_search.assert_called()
+
+
+class LogDatabaseTestCase(TestCase):
+    """Points log's own database at a fresh in-memory SQLite file."""
+
+    def setUp(self):
+        log.db.init(':memory:')
+        log.initialize()
+        log.lookup_cache.clear()
+        log.search_cache = log.SearchCache()
+
+    def tearDown(self):
+        log.db.close()
+        log.db.init('entries.db')
+
+
+class FileDatabaseTestCase(TestCase):
+    """Points log's own database at a fresh file in a temporary
+    directory, for tests that need other connections or files."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'entries.db')
+        log.configure_database(self.path)
+        log.initialize()
+        log.lookup_cache.clear()
+        log.search_cache = log.SearchCache()
+
+    def tearDown(self):
+        log.db.close()
+        log.configure_database()
+        self.directory.cleanup()
+
+
+class ResultCursorTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for day in range(1, 26):
+            log.Entry.create(name="name", task="task{}".format(day),
+                             minutes=day, notes="",
+                             timestamp=datetime.datetime(2018, 1, day))
+
+    def test_first_page(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        self.assertEqual(cursor.entry.task, "task25")
+        self.assertEqual(len(cursor.rows), 10)
+        self.assertTrue(cursor.is_first())
+        self.assertFalse(cursor.is_last())
+
+    def test_next_and_previous_cross_pages(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        for _ in range(12):
+            cursor.next()
+        self.assertEqual(cursor.index, 12)
+        self.assertEqual(cursor.entry.task, "task13")
+        for _ in range(3):
+            cursor.previous()
+        self.assertEqual(cursor.index, 9)
+        self.assertEqual(cursor.entry.task, "task16")
+
+    def test_last_entry(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        for _ in range(30):
+            cursor.next()
+        self.assertEqual(cursor.index, 24)
+        self.assertTrue(cursor.is_last())
+
+    def test_seek(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        self.assertTrue(cursor.seek(20))
+        self.assertEqual(cursor.entry.task, "task5")
+        self.assertFalse(cursor.seek(25))
+        self.assertEqual(cursor.index, 20)
+
+    def test_pages_hold_list_columns(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        self.assertEqual(cursor.rows[0]._fields,
+                         ('id', 'task', 'timestamp', 'sort_key'))
+        self.assertIsInstance(cursor.entry, log.Entry)
+        self.assertEqual(cursor.entry.minutes, 25)
+
+    def test_total_counted_once(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        with benchmarks.count_queries() as counter:
+            self.assertEqual(cursor.total(), 25)
+            self.assertEqual(cursor.page_count(), 3)
+        self.assertEqual(counter['queries'], 1)
+        self.assertEqual(log.IdListCursor(list(range(1, 8))).total(), 7)
+
+    def test_seek_page(self):
+        cursor = log.ResultCursor(log.Entry.select(), page_size=10)
+        self.assertTrue(cursor.seek_page(3))
+        self.assertEqual((cursor.index, cursor.page), (20, 3))
+        self.assertEqual(cursor.entry.task, "task5")
+        self.assertFalse(cursor.seek_page(4))
+
+    def test_view_entries_go_to_page(self):
+        user_input = ['g', '3', 'q']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.clear'):
+                with mock.patch('builtins.print') as mock_print:
+                    log.view_entries()
+                    mock_print.assert_any_call("\nResult 21 of 25, page 3 of 3")
+
+    def test_empty_results(self):
+        cursor = log.ResultCursor(
+            log.Entry.select().where(log.Entry.minutes > 100))
+        self.assertIsNone(cursor.entry)
+
+    def test_view_entries_next(self):
+        user_input = ['n', 'q']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.clear'):
+                with mock.patch('builtins.print') as mock_print:
+                    log.view_entries()
+                    mock_print.assert_any_call(
+                        "\nResult 2 of 25, page 1 of 3")
+
+
+class MigrationTests(LogDatabaseTestCase):
+
+    def index_names(self):
+        return {index.name for index in log.db.get_indexes('entry')}
+
+    def test_new_database_is_current(self):
+        self.assertEqual(log.db.pragma('user_version'), len(log.MIGRATIONS))
+        self.assertIn('entry_timestamp', self.index_names())
+        self.assertIn('entry_name_timestamp', self.index_names())
+        self.assertIn('entry_minutes', self.index_names())
+
+    def test_migrate_old_database(self):
+        log.db.drop_tables([log.Entry])
+        log.db.execute_sql(
+            'CREATE TABLE "entry" ("id" INTEGER NOT NULL PRIMARY KEY, '
+            '"name" VARCHAR(255) NOT NULL, "task" VARCHAR(255) NOT NULL, '
+            '"minutes" INTEGER NOT NULL, "notes" TEXT NOT NULL, '
+            '"timestamp" DATETIME NOT NULL)')
+        log.db.pragma('user_version', 0)
+        log.migrate_database()
+        self.assertEqual(log.db.pragma('user_version'), len(log.MIGRATIONS))
+        self.assertIn('entry_name_timestamp', self.index_names())
+
+
+class SearchTermTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        log.Entry.create(name="a", task="deploy app", minutes=1,
+                         notes="", timestamp=datetime.datetime(2018, 1, 1))
+        log.Entry.create(name="b", task="review", minutes=1,
+                         notes="deployment deployment notes",
+                         timestamp=datetime.datetime(2018, 1, 2))
+        log.Entry.create(name="c", task="lunch", minutes=1,
+                         notes="", timestamp=datetime.datetime(2018, 1, 3))
+
+    def search(self, term):
+        return log.search_method(log.Entry.select(), term, "Term")
+
+    def test_match_terms(self):
+        self.assertEqual(log.match_terms('depl "app'), '"depl"* "app"*')
+
+    def test_no_words_matches_nothing(self):
+        for term in (' ', '"', ' " "'):
+            self.assertEqual(list(self.search(term)), [])
+            self.assertIsNone(log.result_cursor(term, "Term").entry)
+            self.assertIsNone(log.result_cursor({'term': term},
+                                                "Filters").entry)
+
+    def test_prefix_search(self):
+        self.assertEqual({entry.name for entry in self.search("depl")},
+                         {"a", "b"})
+
+    def test_index_follows_edits_and_deletes(self):
+        entry = log.Entry.get(log.Entry.name == "c")
+        entry.notes = "deploy later"
+        entry.save()
+        log.Entry.get(log.Entry.name == "a").delete_instance()
+        self.assertEqual({entry.name for entry in self.search("deploy")},
+                         {"b", "c"})
+
+    def test_ranked_cursor(self):
+        cursor = log.ResultCursor(self.search("deployment"),
+                                  sort_key=log.EntryIndex.bm25(),
+                                  descending=False)
+        self.assertEqual(cursor.entry.name, "b")
+        self.assertTrue(cursor.is_last())
+
+
+class EmployeeSummaryTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, minutes in [("bob", 10), ("amy", 5), ("bob", 20)]:
+            log.Entry.create(name=name, task="task", minutes=minutes,
+                             notes="")
+
+    def test_employee_summary(self):
+        self.assertEqual(log.employee_summary(log.Entry.select()),
+                         [("amy", 1, 5), ("bob", 2, 30)])
+
+    def test_get_employee_names(self):
+        self.assertEqual(log.get_employee_names(log.Entry.select()),
+                         ["amy", "bob"])
+
+    def test_cache_invalidated_on_write(self):
+        self.assertEqual(len(log.all_employees()), 2)
+        user_input = ['cat', 'task', '7', '', 'y']
+        with patch('builtins.input', side_effect=user_input):
+            log.add_entry()
+        self.assertEqual(len(log.all_employees()), 3)
+        self.assertIn((7, 1), log.all_minutes())
+
+
+class ImportExportTests(LogDatabaseTestCase):
+
+    def test_import_csv(self):
+        lines = io.StringIO("name,task,minutes,notes,date\n"
+                            "amy,write,30,some notes,2018-01-02\n"
+                            "bob,read,ten,,2018-01-03\n"
+                            "cat,test,5,,2018-01-04\n")
+        rows = log.read_rows(lines, 'csv')
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as errors:
+            count = log.import_entries(log.valid_rows(rows), chunk_size=1)
+        self.assertEqual(count, 2)
+        self.assertIn("Skipped row 2: minutes must be an integer",
+                      errors.getvalue())
+        entry = log.Entry.get(log.Entry.name == "amy")
+        self.assertEqual(entry.minutes, 30)
+        self.assertEqual(entry.timestamp, datetime.date(2018, 1, 2))
+
+    def test_validate_row(self):
+        with self.assertRaises(ValueError):
+            log.validate_row({'name': 'amy', 'task': '', 'minutes': '1',
+                              'date': '2018-01-01'})
+        with self.assertRaises(ValueError):
+            log.validate_row({'name': 'amy', 'task': 'a', 'minutes': '1',
+                              'date': '01/01/2018'})
+
+    def test_import_jsonl_skips_bad_lines(self):
+        lines = io.StringIO('{"name": "amy", "task": "a", "minutes": 1, '
+                            '"date": "2018-01-01"}\n'
+                            '{"name": "bob", "task": \n'
+                            '[1, 2]\n'
+                            '{"name": 5, "task": "a", "minutes": 1, '
+                            '"date": "2018-01-01"}\n'
+                            '{"name": "cat", "task": "a", "minutes": 1.9, '
+                            '"date": "2018-01-01"}\n'
+                            '{"name": "dan", "task": "a", "minutes": true, '
+                            '"date": "2018-01-01"}\n'
+                            '{"name": "eve", "task": "a", "minutes": "7", '
+                            '"date": "2018-01-01"}\n')
+        rows = log.read_rows(lines, 'jsonl')
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as errors:
+            count = log.import_entries(log.valid_rows(rows), chunk_size=2)
+        self.assertEqual(count, 2)
+        self.assertEqual([(entry.name, entry.minutes)
+                          for entry in log.Entry.select()],
+                         [("amy", 1), ("eve", 7)])
+        for line in range(2, 7):
+            self.assertIn("Skipped row {}:".format(line), errors.getvalue())
+
+    def test_export_import_jsonl(self):
+        log.Entry.create(name="amy", task="write", minutes=30, notes="n",
+                         timestamp=datetime.datetime(2018, 1, 2))
+        out = io.StringIO()
+        self.assertEqual(log.export_entries(out, 'jsonl'), 1)
+        self.assertEqual(json.loads(out.getvalue()),
+                         {'name': 'amy', 'task': 'write', 'minutes': 30,
+                          'notes': 'n', 'date': '2018-01-02'})
+        # Importing what was exported adds nothing new
+        rows = log.read_rows(io.StringIO(out.getvalue()), 'jsonl')
+        self.assertEqual(log.import_entries(log.valid_rows(rows)), 0)
+        self.assertEqual(log.Entry.select().count(), 1)
+
+    def test_bulk_import_catches_up_derived_tables(self):
+        log.Entry.create(name="employee1", task="existing", minutes=5,
+                         notes="", timestamp=datetime.date(2018, 1, 1))
+        rows = list(benchmarks.synthetic_rows(1500))
+        self.assertEqual(log.import_entries(rows, chunk_size=1500), 1500)
+        self.assertEqual(log.import_entries(rows[:10] * 2, chunk_size=1),
+                         0)
+        totals = (log.DailyTotal
+                  .select(fn.SUM(log.DailyTotal.minutes),
+                          fn.SUM(log.DailyTotal.entries)).tuples().get())
+        self.assertEqual(totals, log.Entry.select(
+            fn.SUM(log.Entry.minutes), fn.COUNT(log.Entry.id)).tuples().get())
+        self.assertEqual(
+            sorted(log.Employee.select(log.Employee.name,
+                                       log.Employee.entries).tuples()),
+            sorted(log.Entry.select(log.Entry.name, fn.COUNT(log.Entry.id))
+                   .group_by(log.Entry.name).tuples()))
+        self.assertEqual(log.search_method(log.Entry.select(), "existing",
+                                           "Term").count(), 1)
+        self.assertEqual(
+            log.search_method(log.Entry.select(), rows[0]['task'], "Term")
+            .count(),
+            log.Entry.select().where(log.Entry.task == rows[0]['task'])
+            .count())
+        triggers = [name for name, in log.db.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'")]
+        for name in log.INSERT_TRIGGERS:
+            self.assertIn(name, triggers)
+
+    def test_file_format(self):
+        self.assertEqual(log.file_format('entries.jsonl'), 'jsonl')
+        self.assertEqual(log.file_format('entries.txt'), 'csv')
+        self.assertEqual(log.file_format('entries.txt', 'jsonl'), 'jsonl')
+
+
+class SearchCommandTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        log.Entry.create(name="amy", task="deploy", minutes=30, notes="",
+                         timestamp=datetime.datetime(2018, 1, 2))
+        log.Entry.create(name="amy", task="review", minutes=10, notes="",
+                         timestamp=datetime.datetime(2018, 2, 2))
+        log.Entry.create(name="bob", task="deploy", minutes=30, notes="",
+                         timestamp=datetime.datetime(2018, 1, 5))
+
+    def run_search(self, *argv):
+        with mock.patch('log.initialize'), mock.patch('log.configure_database'):
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                log.main(['search'] + list(argv))
+        return out.getvalue()
+
+    def test_search_employee_range_json(self):
+        output = self.run_search('--employee', 'amy', '--from', '2018-01-01',
+                                 '--to', '2018-01-31', '--format', 'json')
+        rows = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['task'], 'deploy')
+
+    def test_search_text_newest_first(self):
+        output = self.run_search('--term', 'deploy')
+        self.assertEqual(output.splitlines(),
+                         ['bob\tdeploy\t30\t\t2018-01-05',
+                          'amy\tdeploy\t30\t\t2018-01-02'])
+
+    def test_search_does_not_clear(self):
+        with mock.patch('os.system') as mock_clear:
+            self.run_search('--minutes', '10')
+            mock_clear.assert_not_called()
+
+
+class ReportTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, task, minutes, day in [("amy", "a", 30, 1), ("amy", "a", 10, 1),
+                                         ("amy", "b", 5, 9), ("bob", "a", 20, 2)]:
+            log.Entry.create(name=name, task=task, minutes=minutes, notes="",
+                             timestamp=datetime.datetime(2018, 1, day))
+
+    def test_totals_by_name(self):
+        self.assertEqual(list(reports.totals(['name'])),
+                         [("amy", 45, 3), ("bob", 20, 1)])
+
+    def test_totals_by_name_and_week(self):
+        self.assertEqual(list(reports.totals(['name', 'week'])),
+                         [("amy", "2018-W01", 40, 2), ("amy", "2018-W02", 5, 1),
+                          ("bob", "2018-W01", 20, 1)])
+
+    def test_weeks_are_iso_weeks(self):
+        for day in (datetime.date(2019, 12, 29), datetime.date(2019, 12, 30),
+                    datetime.date(2021, 1, 1), datetime.date(2021, 1, 4)):
+            log.Entry.create(name="cat", task="c", minutes=1, notes="",
+                             timestamp=day)
+        self.assertEqual([row[0] for row in reports.totals(['week'])],
+                         ["2018-W01", "2018-W02", "2019-W52", "2020-W01",
+                          "2020-W53", "2021-W01"])
+
+    def test_totals_date_range(self):
+        self.assertEqual(list(reports.totals(['task'],
+                                             start=datetime.datetime(2018, 1, 2))),
+                         [("a", 20, 1), ("b", 5, 1)])
+
+    def test_rollups_follow_edits_and_deletes(self):
+        entry = log.Entry.get(log.Entry.name == "bob")
+        entry.name = "amy"
+        entry.save()
+        log.Entry.get(log.Entry.task == "b").delete_instance()
+        self.assertEqual(list(reports.totals(['name', 'day'])),
+                         [("amy", "2018-01-01", 40, 2),
+                          ("amy", "2018-01-02", 20, 1)])
+        self.assertEqual(log.DailyTotal.select().count(), 2)
+
+    def test_migration_backfills_rollups(self):
+        log.DailyTotal.delete().execute()
+        log.add_daily_totals(None)
+        self.assertEqual(list(reports.totals(['name'])),
+                         [("amy", 45, 3), ("bob", 20, 1)])
+
+
+class BenchmarkTests(LogDatabaseTestCase):
+
+    def test_run_case_counts_queries(self):
+        log.import_entries(benchmarks.synthetic_rows(50))
+        result = benchmarks.run_case(benchmarks.page_forward, repeat=1)
+        # Five pages of results, then the entry on the last one
+        self.assertEqual(result['queries'], 6)
+
+    def test_regressions(self):
+        baselines = {'10': {'case': {'ms': 1.0, 'queries': 1}}}
+        self.assertEqual(benchmarks.regressions(
+            {'10': {'case': {'ms': 1.2, 'queries': 1}}}, baselines), [])
+        self.assertEqual(len(benchmarks.regressions(
+            {'10': {'case': {'ms': 3.0, 'queries': 2}}}, baselines)), 2)
+
+
+class ProfilingTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profiler = profiling.QueryProfiler(log.db, slow_ms=0)
+        self.profiler.install()
+
+    def tearDown(self):
+        self.profiler.uninstall()
+        super().tearDown()
+
+    def test_queries_counted_per_action(self):
+        with mock.patch('profiling.logger'):
+            with self.profiler.action('View'):
+                log.Entry.select().count()
+                log.Entry.select().count()
+        profile = self.profiler.profile()
+        self.assertEqual(profile['View']['calls'], 1)
+        self.assertEqual(profile['View']['queries'], 2)
+        self.assertEqual(profile['View']['statements'][0]['count'], 2)
+        self.assertIn('View: 1 calls, 2 queries', self.profiler.report())
+
+    def test_import_counted(self):
+        rows = list(benchmarks.synthetic_rows(3))
+        with mock.patch('profiling.logger'):
+            with self.profiler.action('Import'):
+                log.import_entries(rows)
+        profile = self.profiler.profile()
+        self.assertEqual(profile['Import']['queries'], 3)
+        self.assertIn("INSERT", profile['Import']['statements'][0]['sql'])
+
+    def test_slow_query_logged_with_plan(self):
+        with mock.patch('profiling.logger') as mock_logger:
+            log.Entry.select().where(log.Entry.minutes == 1).count()
+            plan = mock_logger.warning.call_args[0][-1]
+            self.assertIn('entry_minutes', plan)
+
+    def test_menu_choice_is_an_action(self):
+        log.profiler = self.profiler
+        try:
+            user_input = ['m', '5', 'q', 'q']
+            with patch('builtins.input', side_effect=user_input):
+                with mock.patch('log.clear'), mock.patch('builtins.print'):
+                    with mock.patch('profiling.logger'):
+                        log.menu_loop()
+        finally:
+            log.profiler = None
+        self.assertIn("Search by Entry Minutes Taken",
+                      self.profiler.profile())
+
+
+class DatabaseProfileTests(TestCase):
+
+    def tearDown(self):
+        log.configure_database()
+
+    def test_production_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log.configure_database(os.path.join(directory, 'entries.db'),
+                                   'production')
+            log.initialize()
+            self.assertEqual(log.db.pragma('journal_mode'), 'wal')
+            self.assertEqual(log.db.pragma('synchronous'), 1)
+            self.assertEqual(log.db.pragma('busy_timeout'), 5000)
+            log.db.close()
+
+
+class DateStorageTests(LogDatabaseTestCase):
+
+    def test_default_is_today(self):
+        self.assertTrue(callable(log.Entry.timestamp.default))
+        entry = log.Entry.create(name="a", task="b", minutes=1, notes="")
+        self.assertEqual(log.Entry.get_by_id(entry.id).timestamp,
+                         datetime.date.today())
+
+    def test_search_date_exact(self):
+        log.Entry.create(name="a", task="b", minutes=1, notes="",
+                         timestamp=datetime.datetime(2018, 1, 2, 15, 30))
+        entries = log.search_method(log.Entry.select(),
+                                    datetime.datetime(2018, 1, 2), "Date")
+        self.assertEqual(entries.count(), 1)
+
+    def test_search_range_includes_last_day(self):
+        for day in (1, 2, 3):
+            log.Entry.create(name="a", task="b", minutes=1, notes="",
+                             timestamp=datetime.date(2018, 1, day))
+        entries = log.search_method(log.Entry.select(),
+                                    [datetime.datetime(2018, 1, 2),
+                                     datetime.datetime(2018, 1, 3)], "Range")
+        self.assertEqual(entries.count(), 2)
+
+    def test_migration_normalizes_dates(self):
+        log.Entry.create(name="a", task="b", minutes=5, notes="",
+                         timestamp=datetime.date(2018, 1, 2))
+        log.db.execute_sql("UPDATE entry SET timestamp = '2018-01-02 10:00:00'")
+        log.store_dates(None)
+        self.assertEqual(log.db.execute_sql(
+            'SELECT timestamp FROM entry').fetchone()[0], '2018-01-02')
+        self.assertEqual(log.DailyTotal.get().minutes, 5)
+
+
+class SearchCacheTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for day in range(1, 16):
+            log.Entry.create(name="amy" if day % 2 else "bob",
+                             task="task{}".format(day), minutes=day,
+                             notes="", timestamp=datetime.date(2018, 1, day))
+
+    def test_lru_eviction(self):
+        cache = log.SearchCache(maxsize=2)
+        cache.put('a', 0, [1])
+        cache.put('b', 0, [2])
+        cache.get('a', 0)
+        cache.put('c', 0, [3])
+        self.assertIs(cache.get('b', 0), log.SearchCache.MISSING)
+        self.assertEqual(cache.get('a', 0), [1])
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_total_ids_bounded(self):
+        cache = log.SearchCache(max_ids=5)
+        cache.put('a', 0, [1, 2, 3])
+        cache.put('b', 0, [4, 5, 6])
+        self.assertIs(cache.get('a', 0), log.SearchCache.MISSING)
+        self.assertEqual(cache.stats()['ids'], 3)
+
+    def test_repeat_search_hits_cache(self):
+        first = log.result_cursor("task1", "Term")
+        second = log.result_cursor("task1", "Term")
+        self.assertIsInstance(second, log.IdListCursor)
+        self.assertEqual(second.ids, first.ids)
+        self.assertEqual(len(second.ids), 7)
+        self.assertEqual(log.search_cache.stats()['hits'], 1)
+
+    def test_id_list_cursor_pages(self):
+        ids = [entry.id for entry in log.Entry.select().order_by(
+            log.Entry.timestamp.desc())]
+        cursor = log.IdListCursor(ids)
+        for _ in range(12):
+            cursor.next()
+        self.assertEqual(cursor.entry.task, "task3")
+        for _ in range(3):
+            cursor.previous()
+        self.assertEqual(cursor.entry.task, "task6")
+        self.assertTrue(cursor.seek(14))
+        self.assertTrue(cursor.is_last())
+        self.assertFalse(cursor.seek(15))
+
+    def test_write_invalidates(self):
+        log.result_cursor("task1", "Term")
+        user_input = ['amy', 'task16', '7', '', 'y']
+        with patch('builtins.input', side_effect=user_input):
+            log.add_entry()
+        cursor = log.result_cursor("task1", "Term")
+        self.assertEqual(len(cursor.ids), 8)
+        self.assertEqual(log.search_cache.stats()['hits'], 0)
+
+    def test_too_many_results_not_listed(self):
+        log.search_cache.max_ids = 5
+        cursor = log.result_cursor("task1", "Term")
+        self.assertNotIsInstance(cursor, log.IdListCursor)
+        self.assertTrue(cursor.entry.task.startswith("task1"))
+
+    def test_date_searches_not_listed(self):
+        cursor = log.result_cursor("amy", "Employee")
+        self.assertNotIsInstance(cursor, log.IdListCursor)
+
+    def test_other_connection_invalidates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'entries.db')
+            log.configure_database(path)
+            log.initialize()
+            log.search_cache.clear()
+            self.assertEqual(len(log.result_cursor("b", "Term").ids), 0)
+            other = sqlite3.connect(path)
+            other.execute("INSERT INTO entry (name, task, minutes, notes, "
+                          "timestamp) VALUES ('a', 'b', 1, '', '2018-01-01')")
+            other.commit()
+            other.close()
+            self.assertEqual(len(log.result_cursor("b", "Term").ids), 1)
+            log.db.close()
+
+
+class FilterTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, task, minutes, month in [("alice", "deploy api", 30, 7),
+                                           ("alice", "deploy web", 90, 9),
+                                           ("alice", "review", 30, 8),
+                                           ("bob", "deploy api", 45, 8),
+                                           ("alice", "deploy db", 20, 1)]:
+            log.Entry.create(name=name, task=task, minutes=minutes, notes="",
+                             timestamp=datetime.date(2018, month, 1))
+
+    def tasks(self, filters):
+        return sorted(entry.task for entry in
+                      log.filter_entries(log.Entry.select(), filters))
+
+    def test_combined_filters(self):
+        self.assertEqual(self.tasks({'employee': 'alice', 'term': 'deploy',
+                                     'from_date': datetime.date(2018, 7, 1),
+                                     'to_date': datetime.date(2018, 9, 30)}),
+                         ['deploy api', 'deploy web'])
+
+    def test_minutes_range(self):
+        self.assertEqual(self.tasks({'min_minutes': 30, 'max_minutes': 45}),
+                         ['deploy api', 'deploy api', 'review'])
+
+    def test_unknown_filter(self):
+        with self.assertRaises(ValueError):
+            self.tasks({'colour': 'red'})
+
+    def test_filters_ranked_and_cached(self):
+        filters = {'employee': 'alice', 'term': 'deploy'}
+        log.result_cursor(filters, "Filters")
+        cursor = log.result_cursor(filters, "Filters")
+        self.assertIsInstance(cursor, log.IdListCursor)
+        self.assertEqual(len(cursor.ids), 3)
+
+    def test_search_filters(self):
+        user_input = ['deploy', 'alice', 'ten', '', '40', '2018-08-01', '']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.view_entries') as mock_view:
+                log.search_filters()
+                mock_view.assert_called_with(
+                    {'term': 'deploy', 'employee': 'alice', 'max_minutes': 40,
+                     'from_date': datetime.datetime(2018, 8, 1)}, "Filters")
+
+    def test_menu_loop_filters(self):
+        user_input = ['f', 'q']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.search_filters') as mock_filters:
+                log.menu_loop()
+                mock_filters.assert_called()
+
+
+class BulkChangeTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, task, day in [("amy", "imported", 1), ("amy", "imported", 2),
+                                ("bob", "imported", 3), ("bob", "kept", 4)]:
+            log.Entry.create(name=name, task=task, minutes=10, notes="",
+                             timestamp=datetime.date(2018, 1, day))
+
+    def test_delete_matching_term(self):
+        self.assertEqual(log.delete_matching("imported", "Term"), 3)
+        self.assertEqual([entry.task for entry in log.Entry.select()],
+                         ["kept"])
+        self.assertEqual(log.DailyTotal.select().count(), 1)
+
+    def test_reassign_employee(self):
+        self.assertEqual(log.update_matching("amy", "Employee", name="cat"), 2)
+        self.assertEqual(log.Entry.select()
+                         .where(log.Entry.name == "cat").count(), 2)
+
+    def test_shift_dates(self):
+        filters = {'employee': 'bob'}
+        self.assertEqual(log.shift_dates(filters, "Filters", -3), 2)
+        self.assertEqual(sorted(entry.timestamp for entry in log.Entry.select()
+                                .where(log.Entry.name == "bob")),
+                         [datetime.date(2017, 12, 31), datetime.date(2018, 1, 1)])
+
+    def test_change_all_set_task(self):
+        user_input = ['t', 'renamed', 'y']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.clear'):
+                self.assertEqual(log.change_all("bob", "Employee"), 2)
+        self.assertEqual(log.Entry.select()
+                         .where(log.Entry.task == "renamed").count(), 2)
+
+    def test_change_all_not_confirmed(self):
+        user_input = ['d', 'n']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.clear'):
+                self.assertEqual(log.change_all(None, None), 0)
+        self.assertEqual(log.Entry.select().count(), 4)
+
+
+class EntryWriterTests(FileDatabaseTestCase):
+
+    def tearDown(self):
+        if log.entry_writer is not None:
+            log.stop_writer()
+        super().tearDown()
+
+    def test_batches_written_on_flush(self):
+        writer = log.EntryWriter(batch_size=10, flush_interval=5).start()
+        for number in range(25):
+            writer.add("amy", "task{}".format(number), number)
+        writer.flush()
+        self.assertEqual(log.Entry.select().count(), 25)
+        self.assertEqual(writer.written, 25)
+        writer.close()
+
+    def test_partial_batch_written_on_flush(self):
+        writer = log.EntryWriter(batch_size=100, flush_interval=0.01).start()
+        writer.add("amy", "task", 5)
+        writer.flush()
+        self.assertEqual(log.Entry.select().count(), 1)
+        self.assertEqual(log.Entry.get().timestamp, datetime.date.today())
+        writer.close()
+
+    def test_batch_ends_after_interval(self):
+        writer = log.EntryWriter(batch_size=100, flush_interval=0.01)
+        writer.add("amy", "task", 5)
+        self.assertEqual([entry['task'] for entry in writer.next_batch()],
+                         ["task"])
+
+    def test_bad_durability(self):
+        with self.assertRaises(ValueError):
+            log.EntryWriter(durability='sometimes')
+
+    def test_add_entry_queues_and_menu_flushes(self):
+        log.start_writer(flush_interval=60)
+        user_input = ['a', 'amy', 'task', '12', '', 'y', 'q']
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.clear'), mock.patch('builtins.print'):
+                with mock.patch('log.Entry.create') as mock_create:
+                    log.menu_loop()
+                    mock_create.assert_not_called()
+        self.assertEqual(log.Entry.select().count(), 1)
+
+
+class ArchiveTests(FileDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for year in (2019, 2020, 2021):
+            for day in range(1, 4):
+                log.Entry.create(name="amy", task="deploy {}".format(year),
+                                 minutes=day, notes="",
+                                 timestamp=datetime.date(year, 5, day))
+        self.moved = log.archive_entries(datetime.date(2021, 1, 1))
+
+    def test_entries_moved_to_yearly_archives(self):
+        self.assertEqual(self.moved, 6)
+        self.assertEqual(log.archived_years(), [2019, 2020])
+        self.assertEqual(log.Entry.select().count(), 3)
+        self.assertEqual(log.archive_model(2019).select().count(), 3)
+
+    def test_daily_totals_keep_archived_entries(self):
+        self.assertEqual([row[1] for row in reports.totals(['year'])],
+                         [6, 6, 6])
+
+    def test_routes_only_to_intersecting_years(self):
+        span = [datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)]
+        self.assertEqual(log.archive_years(span, "Range"), [2020])
+        self.assertEqual(log.archive_years("deploy", "Term"), [2019, 2020])
+        self.assertEqual(log.archive_years(datetime.date(2021, 5, 1),
+                                           "Date"), [])
+
+    def test_merged_results_newest_first(self):
+        cursor = log.result_cursor()
+        days = []
+        while True:
+            days.append(cursor.row.timestamp)
+            if cursor.is_last():
+                break
+            cursor.next()
+        self.assertEqual(days, sorted(days, reverse=True))
+        self.assertEqual(len(days), 9)
+        self.assertTrue(cursor.seek(7))
+        self.assertEqual(cursor.entry.timestamp, datetime.date(2019, 5, 2))
+
+    def test_term_search_in_archive(self):
+        cursor = log.result_cursor("deploy 2019", "Term")
+        self.assertEqual([row.task for row in cursor.rows],
+                         ["deploy 2019"] * 3)
+
+    def test_export_includes_archives(self):
+        out = io.StringIO()
+        self.assertEqual(log.export_entries(out, 'text'), 9)
+        days = [line.split('\t')[4] for line in out.getvalue().splitlines()]
+        self.assertEqual(days, sorted(days))
+
+    def test_search_command_reads_archives(self):
+        out = io.StringIO()
+        args = log.parse_args(['search', '--term', 'deploy',
+                               '--to', '2020-12-31'])
+        with patch('sys.stdout', out):
+            log.run_command(args)
+        tasks = [line.split('\t')[1] for line in out.getvalue().splitlines()]
+        self.assertEqual(tasks, ["deploy 2020"] * 3 + ["deploy 2019"] * 3)
+
+    def test_archived_entry_not_archived_twice(self):
+        log.Entry.create(name="amy", task="deploy 2019", minutes=1,
+                         notes="", timestamp=datetime.date(2019, 5, 1))
+        self.assertEqual(log.archive_entries(datetime.date(2020, 1, 1)), 1)
+        self.assertEqual(log.archive_model(2019).select().count(), 3)
+        self.assertEqual([row[1] for row in reports.totals(['year'])],
+                         [6, 6, 6])
+
+    def test_reused_id_archived(self):
+        log.archive_entries(datetime.date(2022, 1, 1))
+        # With every entry archived SQLite hands out id 1 again
+        entry = log.Entry.create(name="bob", task="review", minutes=1,
+                                 notes="", timestamp=datetime.date(2019, 6, 1))
+        self.assertEqual(entry.id, 1)
+        self.assertEqual(log.archive_entries(datetime.date(2020, 1, 1)), 1)
+        self.assertEqual(log.Entry.select().count(), 0)
+        archive = log.archive_model(2019)
+        self.assertEqual(sorted(row.task for row in archive.select()),
+                         ["deploy 2019"] * 3 + ["review"])
+        cursor = log.result_cursor("review", "Term")
+        self.assertEqual(cursor.entry.name, "bob")
+
+
+class TeamSearchTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for team, day in (("ops", 2), ("web", 3)):
+            path = os.path.join(self.directory.name, team + '.db')
+            log.configure_database(path)
+            log.initialize()
+            log.Entry.create(name=team, task="deploy " + team, minutes=5,
+                             notes="", timestamp=datetime.date(2020, 1, day))
+            log.db.close()
+            self.paths.append(path)
+        super().setUp()
+        log.Entry.create(name="amy", task="deploy home", minutes=5,
+                         notes="", timestamp=datetime.date(2020, 1, 1))
+        log.configure_teams(self.paths)
+
+    def tearDown(self):
+        log.configure_teams([])
+        super().tearDown()
+        self.directory.cleanup()
+
+    def test_results_merged_across_teams(self):
+        cursor = log.result_cursor("deploy", "Term")
+        self.assertEqual([row.task for row in cursor.rows],
+                         ["deploy web", "deploy ops", "deploy home"])
+
+    def test_entry_loaded_from_its_team(self):
+        cursor = log.result_cursor("amy", "Employee")
+        self.assertEqual([row.task for row in cursor.rows], ["deploy home"])
+        cursor = log.result_cursor("ops", "Employee")
+        self.assertEqual(cursor.entry.name, "ops")
+        self.assertIn(self.paths[0], cursor.entry._meta.database.database)
+
+    def test_missing_team_database(self):
+        with self.assertRaises(ValueError):
+            log.configure_teams([os.path.join(self.directory.name, 'no.db')])
+        self.assertEqual(len(log.team_models), 2)
+
+    def test_equal_day_and_id_in_every_team(self):
+        # Every database's only entry has id 1, give them the same day
+        # too so each page boundary falls between equal keys
+        log.configure_teams([])
+        for path in self.paths:
+            connection = sqlite3.connect(path)
+            connection.execute("UPDATE entry SET timestamp = '2020-01-01'")
+            connection.commit()
+            connection.close()
+        log.configure_teams(self.paths)
+        cursor = log.MergedCursor(
+            [log.Entry.select()] +
+            [model.select() for model in log.team_models], page_size=1)
+        tasks = [cursor.row.task]
+        while not cursor.is_last():
+            cursor.next()
+            tasks.append(cursor.row.task)
+        self.assertEqual(sorted(tasks),
+                         ["deploy home", "deploy ops", "deploy web"])
+        self.assertEqual(len(tasks), cursor.total())
+        while not cursor.is_first():
+            cursor.previous()
+            tasks.pop()
+        self.assertEqual(cursor.row.task, tasks[0])
+
+    def test_outdated_team_database_refused(self):
+        log.configure_teams([])
+        connection = sqlite3.connect(self.paths[0])
+        connection.execute('PRAGMA user_version = 0')
+        connection.close()
+        with self.assertRaises(ValueError):
+            log.configure_teams(self.paths)
+
+    def test_team_files_opened_read_only(self):
+        log.configure_teams(self.paths, 'production')
+        self.assertEqual(log.result_cursor("deploy", "Term").total(), 3)
+        with self.assertRaises(OperationalError):
+            log.team_models[0].delete().execute()
+        connection = sqlite3.connect(self.paths[0])
+        self.assertEqual(connection.execute('PRAGMA journal_mode')
+                         .fetchone()[0], 'delete')
+        connection.close()
+
+    def test_pool_connections_closed(self):
+        log.result_cursor("deploy", "Term")
+        databases = [model._meta.database for model in log.team_models]
+        # The connections the pool's threads searched with are the ones
+        # closing the team databases closes
+        for database in databases:
+            self.assertIs(log.team_pool.submit(database.connection).result(),
+                          database.connection())
+        log.configure_teams([])
+        self.assertTrue(all(database.is_closed() for database in databases))
+
+    def test_team_entry_not_changed_from_pager(self):
+        user_input = ['d', '', 'q']
+        with patch('builtins.input', side_effect=user_input) as mock_input:
+            with mock.patch('log.clear'):
+                with mock.patch('builtins.print'):
+                    log.view_entries("ops", "Employee")
+        self.assertIn("another team's database",
+                      mock_input.call_args_list[1][0][0])
+        self.assertEqual(log.team_models[0].select().count(), 1)
+
+
+class FollowTests(LogDatabaseTestCase):
+
+    def test_yields_only_new_entries(self):
+        old = log.Entry.create(name="amy", task="old", minutes=5, notes="")
+        follow = log.follow_entries(old.id, interval=0)
+        with patch('log.data_generation', side_effect=[1, 2]):
+            log.Entry.create(name="amy", task="new", minutes=5, notes="")
+            log.Entry.create(name="bob", task="newer", minutes=5, notes="")
+            self.assertEqual([entry.task for entry in next(follow)],
+                             ["new", "newer"])
+        with patch('log.data_generation', side_effect=[2, 3]):
+            follow = log.follow_entries(last_seen=2, interval=0)
+            self.assertEqual([entry.task for entry in next(follow)],
+                             ["newer"])
+
+    def test_idle_polls_only_check_data_version(self):
+        follow = log.follow_entries(interval=0)
+        sleeps = iter(range(5))
+        with patch('log.time.sleep', side_effect=lambda interval:
+                   next(sleeps)):
+            with benchmarks.count_queries() as counter:
+                with self.assertRaises(RuntimeError):
+                    next(follow)
+        # One data_version check and a MAX(id) to start, then one
+        # check per poll
+        self.assertEqual(counter['queries'], 2 + 5)
+
+    def test_watch_stops_on_interrupt(self):
+        with patch('log.follow_entries', side_effect=KeyboardInterrupt):
+            with mock.patch('builtins.print'):
+                log.watch_entries()
+
+class EmployeeMatchTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ("Jonathan Smith", "Jane Smithers", "Joan", "Bo"):
+            log.Entry.create(name=name, task="task", minutes=1, notes="")
+        log.Entry.create(name="Joan", task="another task", minutes=1,
+                         notes="")
+
+    def test_triggers_keep_distinct_names(self):
+        self.assertEqual(log.Employee.get(log.Employee.name == "Joan").entries,
+                         2)
+        entry = log.Entry.get(log.Entry.name == "Bo")
+        entry.name = "Bob"
+        entry.save()
+        log.Entry.get(log.Entry.name == "Jane Smithers").delete_instance()
+        self.assertEqual(sorted(log.Employee.select(log.Employee.name)
+                                .tuples()),
+                         [("Bob",), ("Joan",), ("Jonathan Smith",)])
+        self.assertEqual(log.match_employees("bob"), ["Bob"])
+
+    def test_fuzzy_matches_ranked(self):
+        self.assertEqual(set(log.match_employees("smith")),
+                         {"Jonathan Smith", "Jane Smithers"})
+        self.assertEqual(log.match_employees("Jonathon Smith")[0],
+                         "Jonathan Smith")
+        self.assertEqual(log.match_employees("Jaon"), ["Joan"])
+        self.assertEqual(log.match_employees("Bo"), ["Bo"])
+
+    def test_single_match_searched_by_exact_name(self):
+        with mock.patch('log.view_entries') as mock_view:
+            log.search_employee(log.employee_entries("jonathan"), "jonathan")
+        mock_view.assert_called_with("Jonathan Smith", "Name")
+        entries = log.search_method(log.Entry.select(), "Joan", "Name")
+        self.assertEqual(entries.count(), 2)
+
+    def test_exact_name_matches_only_itself(self):
+        for name in ("Nathan Lee", "Keith Jones"):
+            log.Entry.create(name=name, task="task", minutes=1, notes="")
+        self.assertEqual(log.match_employees("jonathan smith"),
+                         ["Jonathan Smith"])
+        with mock.patch('log.view_entries') as mock_view:
+            log.search_employee(log.employee_entries("jonathan smith"),
+                                "jonathan smith")
+        mock_view.assert_called_with("Jonathan Smith", "Name")
+        self.assertEqual(log.match_employees("Jonathon Smith"),
+                         ["Jonathan Smith"])
+
+class AnalyticsTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.minutes = {"amy": [10, 20, 20, 30, 40, 600], "bob": [5, 5, 15]}
+        for name, minutes in self.minutes.items():
+            for day, value in enumerate(minutes, 1):
+                log.Entry.create(name=name, task="task", minutes=value,
+                                 notes="",
+                                 timestamp=datetime.date(2018, 1, day))
+
+    # numpy.percentile's default, worked out the slow way
+    def percentile(self, values, point):
+        values = sorted(values)
+        position = (len(values) - 1) * point / 100
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+
+    def test_minutes_counted_by_value(self):
+        buffers = analytics.minutes_counts('name')
+        values, counts = buffers["amy"]
+        self.assertEqual(list(values), [10, 20, 30, 40, 600])
+        self.assertEqual(list(counts), [1, 2, 1, 1, 1])
+        with self.assertRaises(ValueError):
+            analytics.minutes_counts('notes')
+
+    def test_percentiles_match_every_entry(self):
+        rows = analytics.summary('name', points=[0, 25, 50, 90, 100])
+        for row in rows:
+            values = self.minutes[row['name']]
+            self.assertEqual(row['entries'], len(values))
+            self.assertAlmostEqual(row['mean'],
+                                   sum(values) / len(values), 2)
+            for point in (0, 25, 50, 90, 100):
+                self.assertAlmostEqual(row['p{}'.format(point)],
+                                       self.percentile(values, point))
+
+    def test_outliers_and_histogram(self):
+        amy = analytics.summary('name', bins=4)[0]
+        self.assertEqual(amy['outliers'], 1)
+        self.assertEqual([count for low, high, count in amy['histogram']],
+                         [5, 0, 0, 1])
+        total = analytics.summary()[0]
+        self.assertEqual((total['group'], total['entries']), ('all', 9))
+
+    def test_date_range(self):
+        rows = analytics.summary('name', start=datetime.date(2018, 1, 3),
+                                 end=datetime.date(2018, 1, 4))
+        self.assertEqual([(row['name'], row['entries']) for row in rows],
+                         [("amy", 2), ("bob", 1)])
+
+    def test_write_summary_json(self):
+        out = io.StringIO()
+        analytics.write_summary(out, 'json', 'name', points=[50])
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(row['name'], row['p50']) for row in rows],
+                         [("amy", 25.0), ("bob", 5.0)])
+
+    def test_percentiles_out_of_range(self):
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as errors:
+            with self.assertRaises(SystemExit):
+                log.parse_args(['stats', '--percentiles', '50', '150'])
+        self.assertIn("--percentiles", errors.getvalue())
+        self.assertEqual(log.parse_args(['stats', '--percentiles', '0',
+                                         '100']).percentiles, [0.0, 100.0])
+        with self.assertRaises(ValueError):
+            analytics.summary('name', points=[-1])
+
+
+class DuplicateTests(LogDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        log.Entry.create(name="amy", task="deploy app", minutes=30,
+                         notes="", timestamp=datetime.date(2018, 1, 2))
+
+    def rows(self, name="amy", task="deploy app"):
+        return [{'name': name, 'task': task, 'minutes': 30, 'notes': '',
+                 'timestamp': datetime.date(2018, 1, 2)}]
+
+    def test_hash_ignores_case_and_spacing(self):
+        self.assertEqual(
+            log.entry_hash("amy", "deploy app", 30, "", "2018-01-02"),
+            log.entry_hash(" Amy", "Deploy  app", 30, None,
+                           datetime.date(2018, 1, 2)))
+        self.assertNotEqual(
+            log.entry_hash("amy", "deploy app", 30, "", "2018-01-02"),
+            log.entry_hash("amy", "deploy app", 31, "", "2018-01-02"))
+
+    def test_import_skips_duplicates(self):
+        self.assertEqual(log.import_entries(self.rows("Amy") * 2), 0)
+        self.assertEqual(log.import_entries(self.rows(task="review") * 2), 1)
+        self.assertEqual(log.Entry.select().count(), 2)
+        self.assertEqual(log.DailyTotal.get(log.DailyTotal.task == "deploy app")
+                         .entries, 1)
+
+    def test_import_updates_duplicates(self):
+        self.assertEqual(log.import_entries(self.rows("Amy"),
+                                            duplicates='update'), 1)
+        self.assertEqual([entry.name for entry in log.Entry.select()],
+                         ["Amy"])
+        self.assertEqual([employee.name for employee in log.Employee.select()
+                          .where(log.Employee.entries > 0)], ["Amy"])
+
+    def test_add_entry_rejects_duplicate(self):
+        log.Entry.create(name="amy", task="deploy app", minutes=30,
+                         notes="")
+        user_input = ['amy', 'Deploy app', '30', '', 'y']
+        with patch('builtins.input', side_effect=user_input):
+            with patch('builtins.print') as mock_print:
+                log.add_entry()
+        mock_print.assert_called_with("That entry is already in the log")
+        self.assertEqual(log.Entry.select().count(), 2)
+
+    def test_update_that_duplicates_changes_nothing(self):
+        log.Entry.create(name="bob", task="deploy app", minutes=30,
+                         notes="", timestamp=datetime.date(2018, 1, 2))
+        with self.assertRaises(IntegrityError):
+            log.update_matching("bob", "Employee", name="amy")
+        self.assertEqual(log.Entry.select()
+                         .where(log.Entry.name == "bob").count(), 1)
+
+    def test_migration_keeps_duplicates_until_dedupe(self):
+        log.db.execute_sql('DROP INDEX entry_content_hash')
+        log.db.execute_sql('ALTER TABLE entry DROP COLUMN content_hash')
+        for name in ("amy", "Amy "):
+            log.db.execute_sql(
+                "INSERT INTO entry (name, task, minutes, notes, timestamp) "
+                "VALUES (?, 'deploy app', 30, '', '2018-01-02')", (name,))
+        log.db.pragma('user_version', len(log.MIGRATIONS) - 1)
+        with mock.patch('logging.Logger.warning') as mock_warning:
+            log.migrate_database()
+        mock_warning.assert_called_once()
+        self.assertEqual(log.Entry.select().count(), 3)
+        with self.assertRaises(IntegrityError):
+            log.Entry.create(name="AMY", task="deploy app", minutes=30,
+                             notes="", timestamp=datetime.date(2018, 1, 2))
+        self.assertEqual(log.dedupe_entries(dry_run=True), 2)
+        self.assertEqual(log.Entry.select().count(), 3)
+        self.assertEqual(log.dedupe_entries(), 2)
+        self.assertEqual(log.Entry.select().count(), 1)
+        self.assertEqual(log.DailyTotal.get().entries, 1)
+        self.assertEqual(log.search_method(log.Entry.select(), "deploy",
+                                           "Term").count(), 1)
+        self.assertEqual(log.dedupe_entries(), 0)
+
+class SnapshotTests(FileDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for day in range(1, 26):
+            log.Entry.create(name="name", task="task{}".format(day),
+                             minutes=day, notes="",
+                             timestamp=datetime.date(2018, 1, day))
+        # Another user's connection to the same file
+        self.other = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.other.close()
+        super().tearDown()
+
+    def other_user_adds(self, day):
+        self.other.execute(
+            "INSERT INTO entry (name, task, minutes, notes, timestamp) "
+            "VALUES ('other', ?, 1, '', ?)",
+            ("new{}".format(day), "2018-02-{:02d}".format(day)))
+        self.other.commit()
+
+    def test_positions_kept_while_others_write(self):
+        cursor = log.result_cursor(snapshot=True)
+        live = log.result_cursor()
+        for day in range(1, 6):
+            self.other_user_adds(day)
+        self.other.execute("DELETE FROM entry WHERE task = 'task25'")
+        self.other.commit()
+        cursor.seek(12)
+        live.seek(12)
+        self.assertEqual(cursor.entry.task, "task13")
+        self.assertEqual(live.entry.task, "task17")
+        self.assertEqual(cursor.total(), 25)
+
+    def test_changes_flagged_until_reloaded(self):
+        cursor = log.result_cursor(snapshot=True)
+        self.assertEqual(cursor.generation, log.data_generation())
+        self.other_user_adds(1)
+        self.assertNotEqual(cursor.generation, log.data_generation())
+        self.assertIsNone(log.result_cursor().generation)
+
+    def test_view_skips_entry_deleted_by_someone_else(self):
+        log.snapshot_results = True
+        self.addCleanup(setattr, log, 'snapshot_results', False)
+
+        def actions():
+            yield 'n'
+            self.other.execute("DELETE FROM entry WHERE task = 'task23'")
+            self.other.commit()
+            yield 'n'
+            yield 'q'
+        with patch('builtins.input', side_effect=actions()):
+            with mock.patch('log.clear'):
+                with mock.patch('builtins.print') as mock_print:
+                    log.view_entries()
+        shown = [call[0][1] for call in mock_print.call_args_list
+                 if call[0][0] == "Task Name: "]
+        self.assertEqual(shown, ["task25", "task24", "task22"])
+        mock_print.assert_any_call("Entries have changed since these "
+                                   "results were listed, r) to reload them")
+
+    def view_in_snapshot(self, user_input):
+        log.snapshot_results = True
+        self.addCleanup(setattr, log, 'snapshot_results', False)
+        with patch('builtins.input', side_effect=user_input):
+            with mock.patch('log.clear'):
+                with mock.patch('builtins.print') as mock_print:
+                    log.view_entries()
+        return mock_print
+
+    def test_delete_last_result(self):
+        # Go to the oldest result, delete it and go back a result
+        mock_print = self.view_in_snapshot(['25', 'd', 'y', 'p', 'q'])
+        mock_print.assert_any_call("\nResult 24 of 24, page 3 of 3")
+        mock_print.assert_any_call("\nResult 23 of 24, page 3 of 3")
+        mock_print.assert_any_call("Task Name: ", "task2")
+        self.assertEqual(log.Entry.select().count(), 24)
+
+    def test_duplicate_edit_leaves_entry_shown(self):
+        # Try to make the newest entry a copy of the one before it
+        mock_print = self.view_in_snapshot(
+            ['e', 'y', 'name', 'task24', '24', '', '2018-01-24', 'q'])
+        mock_print.assert_any_call("That entry is already in the log, "
+                                   "not saved")
+        shown = [call[0][1] for call in mock_print.call_args_list
+                 if call[0][0] == "Task Name: "]
+        self.assertEqual(shown, ["task25", "task25"])
+
+    def test_own_delete_keeps_others_changes_flagged(self):
+        def actions():
+            self.other_user_adds(1)
+            yield 'd'
+            yield 'y'
+            yield 'q'
+        mock_print = self.view_in_snapshot(actions())
+        flagged = [call for call in mock_print.call_args_list
+                   if call == mock.call("Entries have changed since these "
+                                        "results were listed, r) to "
+                                        "reload them")]
+        self.assertEqual(len(flagged), 1)
+
+    def test_every_result_on_last_page_deleted(self):
+        cursor = log.result_cursor(snapshot=True)
+        for day in range(1, 6):
+            self.other.execute("DELETE FROM entry WHERE task = ?",
+                               ("task{}".format(day),))
+        self.other.commit()
+        self.assertTrue(cursor.seek_page(3))
+        self.assertEqual(cursor.row.task, "task6")
+        self.assertEqual(cursor.total(), 20)
+        self.assertEqual((cursor.page, cursor.page_count()), (2, 2))
+        self.assertTrue(cursor.is_last())
+
+
+class CommandLineTests(FileDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        log.Entry.create(name="amy", task="deploy", minutes=5, notes="")
+        log.db.close()
+
+    # Runs log.py as a script from an empty directory, where there
+    # is no entries.db to fall back on
+    def run_log(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'log.py')
+        elsewhere = os.path.join(self.directory.name, 'elsewhere')
+        os.makedirs(elsewhere, exist_ok=True)
+        return subprocess.run(
+            [sys.executable, script, '--database', self.path] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, cwd=elsewhere)
+
+    def test_report_reads_the_given_database(self):
+        result = self.run_log('report', '--format', 'csv')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("amy,5,1", result.stdout)
+
+    def test_stats_reads_the_given_database(self):
+        result = self.run_log('stats', '--by', 'name', '--format', 'json',
+                              '--percentiles', '50')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        row = json.loads(result.stdout)
+        self.assertEqual((row['name'], row['entries'], row['p50']),
+                         ("amy", 1, 5.0))
+
+    def test_dedupe_dry_run_only_counts(self):
+        result = self.run_log('dedupe', '--dry-run')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Found 0 duplicate entries", result.stderr)
+
+
+class StartupTests(FileDatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        log.Entry.create(name="amy", task="deploy", minutes=5, notes="")
+        log.db.close()
+
+    def test_import_skips_optional_modules(self):
+        script = ("import sys, log; print(' '.join(sorted(set(sys.modules) & "
+                  "{'argparse', 'concurrent.futures', 'csv', 'difflib', "
+                  "'heapq', 'playhouse.migrate', 'profiling', 'queue'})))")
+        output = subprocess.run(
+            [sys.executable, '-c', script], stdout=subprocess.PIPE,
+            universal_newlines=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.stdout.strip(), '')
+
+    def test_current_database_initialized_with_one_query(self):
+        log.configure_database(self.path)
+        with benchmarks.count_queries() as counter:
+            log.initialize()
+        self.assertEqual(counter['queries'], 1)
+        self.assertEqual(log.Entry.select().count(), 1)
+
+
 if __name__ == '__main__':
     unittest.main()